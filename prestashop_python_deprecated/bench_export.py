@@ -0,0 +1,362 @@
+#!/usr/bin/python3
+
+"""
+    exporter benchmark
+    (C) 2026 DiffSolutions s.r.o.
+    Licensed under CC BY-SA 4.0
+
+    * runs every feed of exporter against database made by
+      bench_generate.py and reports rows/s, peak RSS and query count
+    * every feed runs in its own process, so peak RSS is per feed,
+      times of feed stages are measured by metrics module
+    * config.py options can be overridden to compare export modes:
+      bench_export.py --set STREAMING="'cursor'" --set WORKERS=1
+    * bench_export.py --pricing 1000000 compares price computation of
+      synthetic variants by specific_price and by PRICE_BACKENDs, no
+      database is needed
+    * bench_export.py --check-prices 1000 compares prices matched by
+      SpecificPriceIndex with linear scan of random specific prices,
+      no database is needed
+    * bench_export.py --rows compares reading rows of feed tables by
+      peewee .dicts() and by exporter.fetch_rows (FAST_ROWS)
+"""
+
+import argparse
+import ast
+import multiprocessing
+import random
+import sys
+import tempfile
+import time
+import types
+import config
+
+FEEDS = ['customers', 'categories', 'products', 'orders']
+
+def run_feed(feed, queue):
+    """ export one feed in child process, report results into queue """
+    import exporter
+    import metrics
+    ctx = exporter.shop_context()
+    if feed == 'products':
+        #products feed needs category names, not measured
+        list(exporter.category_feed(ctx))
+    with metrics.feed(feed) as stats:
+        if feed == 'customers':
+            exporter.export([ctx], 'customer', 'customers.xml', 'CUSTOMERS',
+                            exporter.customer_records([ctx]))
+        elif feed == 'categories':
+            exporter.export([ctx], 'category', 'categories.xml',
+                            'CATEGORIES',
+                            exporter.shared(exporter.category_feed(ctx),
+                                            [ctx]))
+        elif feed == 'products':
+            lookups = exporter.load_product_lookups([ctx],
+                    exporter.datetime.datetime.now())
+            exporter.export_all_products([ctx], lookups)
+        elif feed == 'orders':
+            exporter.export([ctx], 'order', 'orders.xml', 'ORDERS',
+                            exporter.shared(exporter.order_feed(), [ctx]))
+    queue.put(stats)
+
+def run(feeds):
+    mp = multiprocessing.get_context('fork')
+    results = []
+    for feed in feeds:
+        queue = mp.Queue()
+        p = mp.Process(target = run_feed, args = (feed, queue))
+        p.start()
+        p.join()
+        if p.exitcode:
+            sys.exit("{} feed failed".format(feed))
+        result = queue.get()
+        results.append((feed, result))
+    return results
+
+def report(results):
+    print("{:12} {:>10} {:>9} {:>10} {:>8} {:>10}  {}".format(
+        'feed', 'rows', 'seconds', 'rows/s', 'queries', 'peak MB', 'stages'))
+    for feed, r in results:
+        print("{:12} {:>10} {:>9.2f} {:>10.0f} {:>8} {:>10.1f}  {}".format(
+            feed, r['rows'], r['seconds'],
+            r['rows'] / r['seconds'] if r['seconds'] else 0,
+            r['queries'], r['peak_rss'] / 2**20,
+            ' '.join('{} {:.2f}'.format(k, v) for k, v in
+                     sorted(r['stages'].items()))))
+
+def bench_pricing(variants, seed = 1):
+    """
+        price variants (10 per product) by specific_price and by PriceBatch
+        of every backend, prices have to be the same
+    """
+    import exporter
+    import pricing
+    r = random.Random(seed)
+    ctx = types.SimpleNamespace(shop_id = 1, country_id = 1,
+            ps_specific_price_priority = 'id_shop;id_currency;id_country;id_group')
+    taxes = {1: 0.21, 2: 0.15, 3: 0.0}
+    specific = []
+    products = []
+    for pid in range(1, variants // 10 + 1):
+        products.append(({'id_product': pid,
+                          'price': round(r.uniform(1, 1000), 2),
+                          'id_tax_rules_group': r.randint(1, 3)},
+                         [(pid * 10 + i,
+                           [{'price': r.choice([0, round(r.uniform(0.5, 50),
+                                                         2)])}])
+                          for i in range(10)]))
+        kind = r.random()
+        if kind < 0.3:
+            specific.append({'id_product': pid,
+                             'reduction_type': 'percentage',
+                             'reduction': round(r.uniform(0.05, 0.5), 2)})
+        elif kind < 0.5:
+            specific.append({'id_product': pid, 'reduction_type': 'amount',
+                             'reduction_tax': r.randint(0, 1),
+                             'reduction': round(r.uniform(1, 5), 2)})
+    index = exporter.SpecificPriceIndex(specific, ctx)
+    t0 = time.perf_counter()
+    expected = []
+    for product, product_variants in products:
+        expected.append(exporter.specific_price(product, index, taxes))
+        for paid, group in product_variants:
+            if group[0]['price']:
+                expected.append(exporter.specific_price(product, index,
+                        taxes, add_price = group[0]['price'],
+                        id_product_attribute = paid))
+    results = [('specific_price', time.perf_counter() - t0, None)]
+    for backend in ('python', 'numpy'):
+        try:
+            if backend == 'numpy':
+                import numpy
+        except ImportError:
+            print("numpy is not installed, skipping", file = sys.stderr)
+            continue
+        t0 = time.perf_counter()
+        computing = 0
+        prices = []
+        for start in range(0, len(products), config.PRICE_BATCH):
+            batch = pricing.PriceBatch()
+            indexes = []
+            for product, product_variants in \
+                    products[start:start + config.PRICE_BATCH]:
+                tax, matches = exporter.match_prices(product,
+                        product_variants, index, taxes)
+                indexes.extend(exporter.add_prices(batch, product,
+                        product_variants, tax, matches))
+            t1 = time.perf_counter()
+            computed = batch.compute(backend)
+            computing += time.perf_counter() - t1
+            prices.extend(computed[ix] for ix in indexes)
+        results.append((backend, time.perf_counter() - t0, computing))
+        if prices != expected:
+            sys.exit("{} prices differ from specific_price".format(backend))
+    print("{:16} {:>10} {:>9} {:>10} {:>9}".format('backend', 'prices',
+          'seconds', 'prices/s', 'compute'))
+    for backend, seconds, computing in results:
+        print("{:16} {:>10} {:>9.2f} {:>10.0f} {:>9}".format(backend,
+              len(expected), seconds, len(expected) / seconds,
+              '' if computing is None else '{:.2f}'.format(computing)))
+
+class LinearPrices(object):
+    """
+        reference matcher for check_prices, scans all specific price rows
+        filtered in python, the first one in prestashop order matches
+    """
+    def __init__(self, rows, ctx, dt):
+        import exporter
+        self.match_rule = exporter.match_rule
+        self.priority = exporter.price_priority(ctx)
+        self.prices = []
+        for row in rows:
+            if row['id_cart'] or row['id_customer'] or row['id_group'] or \
+                    row['id_country'] or row['from_quantity'] > 1 or \
+                    row['id_shop'] not in {0, ctx.shop_id} or \
+                    row['id_shop_group'] not in {0, ctx.shop_group_id}:
+                continue
+            if row['date_from'] != exporter.ZERO_DATE and \
+                    not row['date_from'] < dt:
+                continue
+            if row['date_to'] != exporter.ZERO_DATE and \
+                    not dt < row['date_to']:
+                continue
+            price = {k: v for k, v in row.items() if v and k not in
+                     {'id_specific_price', 'id_cart', 'id_shop_group',
+                      'from_quantity', 'date_from', 'date_to'}}
+            self.prices.append(price)
+
+    def match(self, product, id_product_attribute = None):
+        if id_product_attribute:
+            product = dict(product,
+                           id_product_attribute = id_product_attribute)
+        best = None
+        for pos, price in enumerate(self.prices):
+            if not self.match_rule(product, price):
+                continue
+            score = sum(weight for field, value, weight in self.priority
+                        if price.get(field, 0) == value)
+            order = (not price.get('id_product_attribute'),
+                     price.get('id_specific_price_rule', 0), -score, pos)
+            if best is None or order < best[0]:
+                best = (order, price)
+        return best[1] if best else None
+
+def check_prices(cases, seed = 1):
+    """
+        prices of random products by SpecificPriceIndex of specific prices
+        loaded by load_specific_prices have to be the same as prices by
+        linear scan of all rows, rows of small id ranges overlap and tie
+        in shop, currency, country, group, customer, dates and quantity
+        specific price table is created in sqlite memory database
+    """
+    import datetime
+    import peewee
+    import exporter
+    from model import SpecificPrice
+    r = random.Random(seed)
+    dt = datetime.datetime(2018, 6, 1, 12, 0, 0)
+    dates = [exporter.ZERO_DATE, exporter.ZERO_DATE, dt,
+             dt - datetime.timedelta(days = 1),
+             dt + datetime.timedelta(days = 1)]
+    priorities = ['id_shop', 'id_currency', 'id_country', 'id_group']
+    taxes = {1: 0.21}
+    checked = 0
+    database = peewee.SqliteDatabase(':memory:')
+    with database.bind_ctx([SpecificPrice]):
+        for case in range(cases):
+            r.shuffle(priorities)
+            ctx = types.SimpleNamespace(shop_id = r.randint(1, 2),
+                    shop_group_id = 1, country_id = r.randint(1, 2),
+                    ps_specific_price_priority = ';'.join(priorities))
+            rows = []
+            rare = lambda value: value if r.random() < 0.05 else 0
+            for i in range(r.randint(0, 40)):
+                pid = r.randint(0, 4)
+                rows.append({'id_specific_price': i + 1,
+                    'id_specific_price_rule': r.choice([0, 0, 1, 2]),
+                    'id_cart': rare(1),
+                    'id_product': pid,
+                    'id_shop': r.choice([0, 1, 2]),
+                    'id_shop_group': r.choice([0, 0, 1, 1, 2]),
+                    'id_currency': r.choice([0, 0, 0, 1]),
+                    'id_country': rare(r.randint(1, 2)),
+                    'id_group': rare(1),
+                    'id_customer': rare(1),
+                    'id_product_attribute': r.choice([0, 0,
+                            pid * 10 + r.randint(1, 2), r.randint(1, 50)]),
+                    'price': -1.0,
+                    'from_quantity': r.choice([0, 1, 1, 1, 2]),
+                    'reduction': r.choice([0.1, 0.25, 0.5, 3.0]),
+                    'reduction_tax': r.randint(0, 1),
+                    'reduction_type': r.choice(['percentage', 'amount']),
+                    'date_from': r.choice(dates),
+                    'date_to': r.choice(dates)})
+            for row in rows:
+                if row['reduction_type'] == 'percentage':
+                    row['reduction'] = min(row['reduction'], 0.5)
+            database.drop_tables([SpecificPrice])
+            database.create_tables([SpecificPrice])
+            if rows:
+                SpecificPrice.insert_many(rows).execute()
+            index = exporter.SpecificPriceIndex(
+                    exporter.load_specific_prices([ctx], dt)[0], ctx)
+            linear = LinearPrices(rows, ctx, dt)
+            for pid in range(1, 5):
+                product = {'id_product': pid, 'price': 100.0,
+                           'id_tax_rules_group': 1}
+                for paid in (None, pid * 10 + 1, pid * 10 + 2):
+                    price = exporter.specific_price(product, index, taxes,
+                            id_product_attribute = paid)
+                    expected = exporter.specific_price(product, linear,
+                            taxes, id_product_attribute = paid)
+                    if price != expected:
+                        sys.exit("case {}: product {} combination {} price "
+                                 "{} differs from linear scan {}".format(
+                                 case, pid, paid, price, expected))
+                    checked += 1
+    print("{} prices of {} cases are the same as by linear scan".format(
+          checked, cases))
+
+def bench_rows():
+    """
+        read rows of feed queries by peewee and by fetch_rows,
+        rows have to be the same
+    """
+    import exporter
+    from model import Customer, Order, Product
+    ctx = exporter.shop_context()
+    queries = [
+        ('customers', lambda: exporter.stream(Customer.select()
+            .order_by(Customer.id_customer), Customer.id_customer)),
+        ('products', lambda: exporter.stream(Product.select()
+            .order_by(Product.id_product), Product.id_product)),
+        ('product texts', lambda: exporter.load_product_texts(ctx)),
+        ('variants', lambda: exporter.load_variants()),
+        ('orders', lambda: exporter.stream(Order.select()
+            .order_by(Order.id_order), Order.id_order)),
+        ('order items', lambda: exporter.load_order_items()),
+    ]
+    print("{:16} {:>10} {:>12} {:>12} {:>8}".format('query', 'rows',
+          'peewee r/s', 'fast r/s', 'speedup'))
+    for name, query in queries:
+        seconds = []
+        results = []
+        for fast in (False, True):
+            exporter.FAST_ROWS = fast
+            t0 = time.perf_counter()
+            results.append(list(query()))
+            seconds.append(time.perf_counter() - t0)
+        if results[0] != results[1]:
+            sys.exit("{} rows differ".format(name))
+        rows = len(results[0])
+        print("{:16} {:>10} {:>12.0f} {:>12.0f} {:>7.2f}x".format(name, rows,
+              rows / seconds[0], rows / seconds[1], seconds[0] / seconds[1]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+            formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-name', default = 'prestashop_bench')
+    parser.add_argument('--db-user', default = config.DB_USER)
+    parser.add_argument('--db-password', default = config.DB_PASSWORD)
+    parser.add_argument('--db-host', default = config.DB_HOST)
+    parser.add_argument('--db-port', type = int, default = config.DB_PORT)
+    parser.add_argument('--output', help = 'output directory, temporary '
+                        'directory by default')
+    parser.add_argument('--set', action = 'append', default = [],
+                        metavar = 'NAME=VALUE',
+                        help = 'override config.py option (python literal)')
+    parser.add_argument('--pricing', type = int, metavar = 'VARIANTS',
+                        help = 'benchmark price computation of VARIANTS '
+                               'synthetic variants instead of feeds')
+    parser.add_argument('--check-prices', type = int, metavar = 'CASES',
+                        help = 'check prices of CASES random specific price '
+                               'tables against linear scan')
+    parser.add_argument('--rows', action = 'store_true',
+                        help = 'benchmark reading rows of feed tables '
+                               'instead of feeds')
+    parser.add_argument('feeds', nargs = '*', metavar = 'feed',
+                        help = 'feeds to run: {}'.format(', '.join(FEEDS)))
+    args = parser.parse_args()
+    for feed in args.feeds:
+        if feed not in FEEDS:
+            parser.error("unknown feed {}".format(feed))
+    config.DB_NAME = args.db_name
+    config.DB_USER = args.db_user
+    config.DB_PASSWORD = args.db_password
+    config.DB_HOST = args.db_host
+    config.DB_PORT = args.db_port
+    for option in args.set:
+        name, value = option.split('=', 1)
+        setattr(config, name, ast.literal_eval(value))
+    if args.pricing:
+        bench_pricing(args.pricing)
+        sys.exit()
+    if args.check_prices:
+        check_prices(args.check_prices)
+        sys.exit()
+    if args.rows:
+        bench_rows()
+        sys.exit()
+    with tempfile.TemporaryDirectory() as tmp:
+        config.OUTPUT_DIRECTORY = args.output or tmp
+        report(run(args.feeds or FEEDS))
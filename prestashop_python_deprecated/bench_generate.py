@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+
+"""
+    synthetic prestashop database for exporter benchmarks
+    (C) 2026 DiffSolutions s.r.o.
+    Licensed under CC BY-SA 4.0
+
+    * creates tables of models from model.py in separate MySQL database
+      and fills them with random data of given scale
+    * scale is number of products, whole database has roughly
+      25 * scale rows (scale 400 000 makes 10M rows)
+    * usage: bench_generate.py --db-name prestashop_bench --scale 10000
+"""
+
+import argparse
+import collections
+import datetime
+import itertools
+import random
+import sys
+import config
+
+BATCH = 1000
+
+def connect_params(args):
+    return dict(user = args.db_user, password = args.db_password,
+                host = args.db_host, port = args.db_port)
+
+def create_database(args):
+    import pymysql
+    conn = pymysql.connect(**connect_params(args))
+    with conn.cursor() as c:
+        c.execute("CREATE DATABASE IF NOT EXISTS `{}` CHARACTER SET utf8mb4"
+                  .format(args.db_name))
+    conn.close()
+
+def insert(model, fields, rows):
+    """ bulk insert of row tuples in batches """
+    rows = iter(rows)
+    while True:
+        batch = [row for _, row in zip(range(BATCH), rows)]
+        if not batch:
+            return
+        model.insert_many(batch, fields = fields).execute()
+
+def generate(scale, seed):
+    import model as m
+    r = random.Random(seed)
+    dt = datetime.datetime(2018, 1, 1)
+    models = [m.Language, m.Config, m.GenderLang, m.Customer, m.Address,
+              m.Order, m.OrderHistory, m.OrderDetail, m.Product,
+              m.ProductLang, m.ProductAttribute,
+              m.ProductAttributeCombination, m.Attribute, m.AttributeLang,
+              m.AttributeGroupLang, m.Stock, m.SpecificPrice,
+              m.SpecificPriceRule, m.SpecificPriceConditionGroup,
+              m.SpecificPriceCondition, m.Category, m.CategoryLang,
+              m.ProductCategory, m.ProductSupplier, m.FeatureProduct,
+              m.Tax, m.TaxRule, m.Image]
+    #indexes prestashop has on columns used by exporter
+    for model, fields in [(m.Address, [m.Address.id_customer]),
+            (m.OrderHistory, [m.OrderHistory.id_order]),
+            (m.ProductAttribute, [m.ProductAttribute.id_product]),
+            (m.ProductAttributeCombination,
+                [m.ProductAttributeCombination.id_product_attribute]),
+            (m.Stock, [m.Stock.id_product, m.Stock.id_product_attribute,
+                       m.Stock.id_shop]),
+            (m.SpecificPrice, [m.SpecificPrice.id_product]),
+            (m.ProductCategory, [m.ProductCategory.id_product]),
+            (m.Image, [m.Image.id_product]),
+            (m.TaxRule, [m.TaxRule.id_country])]:
+        model.add_index(*fields)
+    db = m.db
+    db.execute_sql("SET FOREIGN_KEY_CHECKS = 0")
+    db.drop_tables(models, safe = True)
+    db.create_tables(models)
+
+    customers = scale
+    categories = max(10, scale // 100)
+    attributes = 40
+    orders = 2 * scale
+    lang = 1
+    shop = config.SHOP_ID or 1
+    country = config.COUNTRY_ID or 1
+
+    #date windows of specific prices, most of them are active
+    active_to = datetime.datetime.now() + datetime.timedelta(days = 3650)
+    ids = collections.defaultdict(lambda: itertools.count(1))
+    next_id = lambda model: next(ids[model])
+
+    with db.atomic():
+        insert(m.Language, [m.Language.id_lang, m.Language.iso_code,
+                            m.Language.name],
+               [(lang, config.LANG, 'Language')])
+        insert(m.Config, [m.Config.id_configuration, m.Config.name,
+                          m.Config.value],
+               [(1, 'PS_VERSION_DB', '1.7.4.2'),
+                (2, 'PS_SHOP_DEFAULT', str(shop)),
+                (3, 'PS_COUNTRY_DEFAULT', str(country)),
+                (4, 'PS_SPECIFIC_PRICE_PRIORITIES',
+                 'id_shop;id_currency;id_country;id_group'),
+                (5, 'PS_SPECIFIC_PRICE_FEATURE_ACTIVE', '1')])
+        insert(m.GenderLang, [m.GenderLang.id_gender, m.GenderLang.id_lang,
+                              m.GenderLang.name],
+               [(1, lang, 'Mr.'), (2, lang, 'Mrs.')])
+        insert(m.Tax, [m.Tax.id_tax, m.Tax.rate], [(1, 21.0), (2, 15.0)])
+        insert(m.TaxRule, [m.TaxRule.id_tax_rule, m.TaxRule.id_tax_rules_group,
+                           m.TaxRule.id_country, m.TaxRule.id_tax],
+               [(1, 1, country, 1), (2, 2, country, 2)])
+
+        #category tree: 1 is root of all, 2 is shop root (home)
+        parents = {1: 0, 2: 1}
+        for c in range(3, categories + 1):
+            parents[c] = r.randint(2, c - 1)
+        insert(m.Category, [m.Category.id_category, m.Category.id_parent,
+                            m.Category.id_shop_default,
+                            m.Category.is_root_category],
+               [(c, p, 1, int(c == 2)) for c, p in parents.items()])
+        insert(m.CategoryLang, [m.CategoryLang.id_category,
+                                m.CategoryLang.id_shop, m.CategoryLang.id_lang,
+                                m.CategoryLang.name,
+                                m.CategoryLang.link_rewrite,
+                                m.CategoryLang.description],
+               [(c, shop, lang, 'Category {}'.format(c),
+                 'category-{}'.format(c), '') for c in parents])
+
+        insert(m.AttributeGroupLang, [m.AttributeGroupLang.id_attribute_group,
+                                      m.AttributeGroupLang.id_lang,
+                                      m.AttributeGroupLang.public_name],
+               [(g, lang, 'Group {}'.format(g)) for g in range(1, 5)])
+        insert(m.Attribute, [m.Attribute.id_attribute,
+                             m.Attribute.id_attribute_group],
+               [(a, (a - 1) % 4 + 1) for a in range(1, attributes + 1)])
+        insert(m.AttributeLang, [m.AttributeLang.id_attribute,
+                                 m.AttributeLang.id_lang,
+                                 m.AttributeLang.name],
+               [(a, lang, 'Value {}'.format(a))
+                for a in range(1, attributes + 1)])
+
+        def products():
+            for p in range(1, scale + 1):
+                yield (p, 1, r.randint(3, categories), r.choice([1, 2]),
+                       r.randint(0, 20), 0,
+                       r.randint(0, 100), round(r.uniform(1, 1000), 2),
+                       round(r.uniform(0, 500), 2), 'REF{}'.format(p),
+                       int(r.random() > 0.05), 1,
+                       r.choice(['both', 'both', 'catalog', 'none']), '',
+                       r.choice([0, 10.5]), r.choice([0, 5.0]),
+                       r.choice([0, 20.0]), r.choice([0, 0.25]),
+                       dt + datetime.timedelta(minutes = p))
+        insert(m.Product, [m.Product.id_product, m.Product.id_shop_default,
+                           m.Product.id_category_default,
+                           m.Product.id_tax_rules_group,
+                           m.Product.id_manufacturer, m.Product.on_sale,
+                           m.Product.quantity, m.Product.price,
+                           m.Product.wholesale_price, m.Product.reference,
+                           m.Product.active, m.Product.show_price,
+                           m.Product.visibility, m.Product.location,
+                           m.Product.width, m.Product.depth,
+                           m.Product.height, m.Product.weight,
+                           m.Product.date_upd], products())
+        insert(m.ProductLang, [m.ProductLang.product, m.ProductLang.id_lang,
+                               m.ProductLang.id_shop, m.ProductLang.name,
+                               m.ProductLang.description,
+                               m.ProductLang.description_short,
+                               m.ProductLang.link_rewrite],
+               ((p, lang, shop, 'Product {}'.format(p),
+                 '<p>Description of product {} &amp; more</p>'.format(p) * 4,
+                 '', 'product-{}'.format(p)) for p in range(1, scale + 1)))
+        insert(m.Image, [m.Image.id_image, m.Image.id_product],
+               ((p * 3 + i, p) for p in range(1, scale + 1)
+                for i in range(r.randint(1, 3))))
+        insert(m.ProductCategory, [m.ProductCategory.id_category,
+                                   m.ProductCategory.id_product],
+               ((c, p) for p in range(1, scale + 1)
+                for c in set(r.randint(3, categories) for i in range(2))))
+
+        #variants, about 3 per product
+        variants = []
+        id_pa = 0
+        for p in range(1, scale + 1):
+            n = r.choice([0, 0, 2, 4, 6])
+            for v in range(n):
+                id_pa += 1
+                variants.append((p, id_pa, r.choice([0, 0, 5.0, 12.5]),
+                                 int(v == 0) if n else 0))
+            if len(variants) >= BATCH or p == scale:
+                insert(m.ProductAttribute, [m.ProductAttribute.id_product,
+                        m.ProductAttribute.id_product_attribute,
+                        m.ProductAttribute.price,
+                        m.ProductAttribute.default_on], variants)
+                insert(m.ProductAttributeCombination,
+                       [m.ProductAttributeCombination.id_attribute,
+                        m.ProductAttributeCombination.id_product_attribute],
+                       ((a, v[1]) for v in variants
+                        for a in r.sample(range(1, attributes + 1), 2)))
+                insert(m.Stock, [m.Stock.id_stock_available,
+                                 m.Stock.id_product,
+                                 m.Stock.id_product_attribute,
+                                 m.Stock.id_shop, m.Stock.quantity],
+                       ((next_id(m.Stock), v[0], v[1], shop,
+                         r.randint(0, 20)) for v in variants))
+                variants = []
+        insert(m.Stock, [m.Stock.id_stock_available, m.Stock.id_product,
+                         m.Stock.id_product_attribute, m.Stock.id_shop,
+                         m.Stock.quantity],
+               ((next_id(m.Stock), p, 0, shop, r.randint(0, 100))
+                for p in range(1, scale + 1)))
+
+        insert(m.SpecificPrice, [m.SpecificPrice.id_specific_price,
+                m.SpecificPrice.id_specific_price_rule,
+                m.SpecificPrice.id_cart, m.SpecificPrice.id_product,
+                m.SpecificPrice.id_shop, m.SpecificPrice.id_shop_group,
+                m.SpecificPrice.id_currency, m.SpecificPrice.id_country,
+                m.SpecificPrice.id_group, m.SpecificPrice.id_customer,
+                m.SpecificPrice.id_product_attribute, m.SpecificPrice.price,
+                m.SpecificPrice.from_quantity, m.SpecificPrice.reduction,
+                m.SpecificPrice.reduction_tax,
+                m.SpecificPrice.reduction_type, m.SpecificPrice.date_from,
+                m.SpecificPrice.date_to],
+               ((i + 1, 0, r.choice([0, 0, 0, 1000 + i]), r.randint(1, scale),
+                 r.choice([0, shop]), 0, 0, 0, r.choice([0, 0, 3]), 0, 0,
+                 -1.0, r.choice([1, 1, 1, 5]), r.choice([0.1, 0.2, 50.0]),
+                 r.choice([0, 1]), r.choice(['percentage', 'amount']),
+                 dt, r.choice([active_to, active_to, dt]))
+               for i in range(scale // 10)))
+        insert(m.SpecificPriceRule, [m.SpecificPriceRule.id_specific_price_rule,
+                m.SpecificPriceRule.id_shop, m.SpecificPriceRule.id_currency,
+                m.SpecificPriceRule.id_country, m.SpecificPriceRule.id_group,
+                m.SpecificPriceRule.price, m.SpecificPriceRule.name,
+                m.SpecificPriceRule.from_quantity,
+                m.SpecificPriceRule.reduction,
+                m.SpecificPriceRule.reduction_tax,
+                m.SpecificPriceRule.reduction_type,
+                m.SpecificPriceRule.date_from, m.SpecificPriceRule.date_to],
+               [(i, 0, 0, 0, 0, -1.0, 'Rule {}'.format(i), 1, 0.1, 1,
+                 'percentage', dt, active_to) for i in range(1, 11)])
+        insert(m.SpecificPriceConditionGroup,
+               [m.SpecificPriceConditionGroup.id_specific_price_rule_condition_group,
+                m.SpecificPriceConditionGroup.id_specific_price_rule],
+               [(i, i) for i in range(1, 11)])
+        insert(m.SpecificPriceCondition,
+               [m.SpecificPriceCondition.id_specific_price_rule_condition,
+                m.SpecificPriceCondition.id_specific_price_rule_condition_group,
+                m.SpecificPriceCondition.typ, m.SpecificPriceCondition.value],
+               [(i, i, 'category', str(r.randint(3, categories))) if i % 2
+                else (i, i, 'manufacturer', str(r.randint(1, 20)))
+                for i in range(1, 11)])
+
+        def customers_rows():
+            for c in range(1, customers + 1):
+                yield (c, 1, r.choice([0, 1, 2]), lang, '', '',
+                       'First{}'.format(c), 'Last{}'.format(c), '',
+                       dt - datetime.timedelta(days = r.randint(7000, 25000)),
+                       r.randint(0, 1), r.randint(0, 1), '', 1, 0,
+                       int(r.random() < 0.01),
+                       dt + datetime.timedelta(minutes = c),
+                       dt + datetime.timedelta(minutes = 2 * c),
+                       'customer{}@example.com'.format(c))
+        insert(m.Customer, [m.Customer.id_customer, m.Customer.id_shop,
+                            m.Customer.gender, m.Customer.id_lang,
+                            m.Customer.company, m.Customer.siret,
+                            m.Customer.firstname, m.Customer.lastname,
+                            m.Customer.passwd, m.Customer.birthday,
+                            m.Customer.newsletter, m.Customer.optin,
+                            m.Customer.website, m.Customer.active,
+                            m.Customer.is_guest, m.Customer.deleted,
+                            m.Customer.date_add, m.Customer.date_upd,
+                            m.Customer.email], customers_rows())
+        insert(m.Address, [m.Address.id_address, m.Address.id_customer,
+                           m.Address.postcode, m.Address.phone,
+                           m.Address.phone_mobile],
+               ((c, c, '{:05}'.format(r.randint(10000, 99999)),
+                 '+420 {}'.format(c), '') for c in range(1, customers + 1)))
+
+        def orders_rows():
+            for o in range(1, orders + 1):
+                c = r.randint(1, customers)
+                yield (o, shop, c, o, 1, c, r.choice([2, 3, 4, 5, 6]),
+                       dt + datetime.timedelta(minutes = o),
+                       dt + datetime.timedelta(days = 2, minutes = o))
+        insert(m.Order, [m.Order.id_order, m.Order.id_shop,
+                         m.Order.id_customer, m.Order.id_cart,
+                         m.Order.id_currency, m.Order.id_address_delivery,
+                         m.Order.current_state, m.Order.date_add,
+                         m.Order.delivery_date], orders_rows())
+        insert(m.OrderHistory, [m.OrderHistory.id_order_history,
+                                m.OrderHistory.id_order,
+                                m.OrderHistory.id_order_state,
+                                m.OrderHistory.date_add],
+               ((next_id(m.OrderHistory), o, s, dt)
+                for o in range(1, orders + 1) for s in (1, 2)))
+        insert(m.OrderDetail, [m.OrderDetail.id_order_detail,
+                               m.OrderDetail.id_order, m.OrderDetail.id_shop,
+                               m.OrderDetail.product_id,
+                               m.OrderDetail.product_attribute_id,
+                               m.OrderDetail.total_price_tax_incl,
+                               m.OrderDetail.unit_price_tax_incl,
+                               m.OrderDetail.product_quantity],
+               ((next_id(m.OrderDetail), o, shop, r.randint(1, scale), 0,
+                 round(r.uniform(1, 1000), 2), 1.0, float(r.randint(1, 3)))
+                for o in range(1, orders + 1)
+                for i in range(r.randint(1, 5))))
+    db.execute_sql("SET FOREIGN_KEY_CHECKS = 1")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+            formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-name', default = 'prestashop_bench')
+    parser.add_argument('--db-user', default = config.DB_USER)
+    parser.add_argument('--db-password', default = config.DB_PASSWORD)
+    parser.add_argument('--db-host', default = config.DB_HOST)
+    parser.add_argument('--db-port', type = int, default = config.DB_PORT)
+    parser.add_argument('--scale', type = int, default = 10000,
+                        help = 'number of products')
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+    if args.db_name == config.DB_NAME:
+        sys.exit("refusing to overwrite shop database {}".format(
+            config.DB_NAME))
+    create_database(args)
+    config.DB_NAME = args.db_name
+    config.DB_USER = args.db_user
+    config.DB_PASSWORD = args.db_password
+    config.DB_HOST = args.db_host
+    config.DB_PORT = args.db_port
+    generate(args.scale, args.seed)
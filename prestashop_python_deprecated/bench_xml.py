@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+"""
+    benchmark of feed record building and serialization
+    (C) 2026 DiffSolutions s.r.o.
+    Licensed under CC BY-SA 4.0
+
+    * builds PRODUCT records shaped like products feed records
+      with every XML_BACKEND, no database is needed
+    * usage: bench_xml.py [records] [variants per product]
+"""
+
+from xml_writer import Feed, Record, SubElement
+from lxml import etree
+import os
+import sys
+import tempfile
+import time
+
+BACKENDS = [('lxml', etree.Element), ('string', Record)]
+
+def parameter(p, name, val):
+    sp = SubElement(p, "PARAMETER")
+    i = SubElement(sp, "NAME")
+    i.text = str(name)
+    i = SubElement(sp, "VALUE")
+    i.text = str(val)
+
+def product(Element, product_id, variants):
+    el = Element("PRODUCT")
+    i = SubElement(el, "PRODUCT_ID")
+    i.text = "{}-0".format(product_id)
+    i = SubElement(el, "TITLE")
+    i.text = "Tričko <{}> & kšiltovka".format(product_id)
+    i = SubElement(el, "DESCRIPTION")
+    i.text = "<p>Popis produktu {}</p>\r\n".format(product_id) * 5
+    i = SubElement(el, "URL")
+    i.text = "http://localhost/prestashop/cs/obleceni/{}-tricko.html"\
+            .format(product_id)
+    i = SubElement(el, "STOCK")
+    i.text = str(product_id % 17)
+    i = SubElement(el, "PRICE")
+    i.text = str(product_id * 1.21)
+    par = SubElement(el, "PARAMETERS")
+    parameter(par, "width", 1.5)
+    parameter(par, "weight", 0.3)
+    for v in range(variants):
+        variant_id = "{}-{}".format(product_id, v + 1)
+        var = SubElement(el, "VARIANT")
+        i = SubElement(var, "PRODUCT_ID")
+        i.text = variant_id
+        i = SubElement(var, "URL")
+        i.text = "http://localhost/prestashop/cs/obleceni/{}-tricko.html"\
+                .format(variant_id)
+        par = SubElement(var, "PARAMETERS")
+        parameter(par, "Velikost", "XL")
+        parameter(par, "Barva", "černá")
+    return el
+
+def bench(Element, records, variants, fname):
+    t_build = t_write = 0
+    with Feed('product', fname, 'PRODUCTS') as f:
+        for product_id in range(1, records + 1):
+            t0 = time.perf_counter()
+            el = product(Element, product_id, variants)
+            t1 = time.perf_counter()
+            f.write(el)
+            t_write += time.perf_counter() - t1
+            t_build += t1 - t0
+    return (t_build, t_write)
+
+if __name__ == '__main__':
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    variants = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    outputs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, Element in BACKENDS:
+            fname = os.path.join(tmp, name + '.xml')
+            t_build, t_write = bench(Element, records, variants, fname)
+            print("{:8} build {:7.2f} us/record  write {:7.2f} us/record  "
+                  "total {:7.2f} us/record".format(name,
+                      t_build / records * 1e6, t_write / records * 1e6,
+                      (t_build + t_write) / records * 1e6))
+            with open(fname, 'rb') as f:
+                outputs.append(f.read())
+    print("outputs identical:", all(o == outputs[0] for o in outputs))
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+"""
+    checkpoints of feed export
+    (C) 2026 DiffSolutions s.r.o.
+    Licensed under CC BY-SA 4.0
+
+    * export of feed saves key of the last written record and sizes of
+      partially written feed files (fname.tmp) after every chunk
+    * failed export keeps partial files, the next run truncates them to
+      saved sizes and continues with records after the saved key
+"""
+
+import json
+import os
+import time
+
+class Checkpoint(object):
+    """
+        progress of feed written into paths, saved in fname
+        key - key of the last written record, set by records generator
+        offsets - sizes of partial files to continue from, None if export
+            starts from the beginning
+    """
+    def __init__(self, fname, paths, max_age):
+        self.fname = fname
+        self.paths = list(paths)
+        self.key = None
+        self.offsets = None
+        state = self.load()
+        if state is None:
+            return
+        if state['paths'] != self.paths or \
+                time.time() - state['time'] > max_age * 3600:
+            return
+        for path, offset in zip(self.paths, state['offsets']):
+            tmp = path + '.tmp'
+            if not os.path.exists(tmp) or os.path.getsize(tmp) < offset:
+                return
+        self.key = state['key']
+        self.offsets = state['offsets']
+
+    def load(self):
+        if not os.path.exists(self.fname):
+            return None
+        try:
+            with open(self.fname) as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def save(self, offsets):
+        """ save checkpoint, offsets - sizes of written files """
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'key': self.key, 'offsets': offsets,
+                       'paths': self.paths, 'time': time.time()}, f)
+        os.replace(tmp, self.fname)
+
+    def clear(self):
+        """ feed is complete """
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
@@ -6,6 +6,8 @@
     * you have to select your shop id and language for export
 """
 
+import os
+
 """ prestashop id_shop, typically 1 """
 SHOP_ID = None #take config from PS_SHOP_DEFAULT
 SHOP_GROUP_ID = 1 #default shop group id
@@ -51,6 +53,188 @@ LANG = 'cs'
     (generated by pwgen 30) """
 OUTPUT_DIRECTORY = '/var/www/prestashop/samba-export/'
 
+"""
+    Storefronts exported in one run, list of
+    (SHOP_ID, LANG, OUTPUT_DIRECTORY) tuples, SHOP_ID None means
+    PS_SHOP_DEFAULT. Every target gets its own set of feeds. Products,
+    variants, stock, prices, customers and orders are read once for all
+    targets, only texts from *_lang tables are read per target.
+    Orders feed is the same for all targets.
+    Empty list exports SHOP_ID and LANG into OUTPUT_DIRECTORY.
+"""
+TARGETS = []
+
+"""
+    Streaming of big feed queries (customers, products, orders).
+    None - default buffered cursor, whole result is loaded into memory
+    'cursor' - unbuffered server side cursor (pymysql SSCursor), every
+        streamed query uses its own connection. Slow export can hit
+        net_write_timeout of MySQL server, raise it if needed.
+    'keyset' - results are read in chunks of CHUNK_SIZE rows paginated by
+        primary key, works with any connection
+"""
+STREAMING = None
+CHUNK_SIZE = 10000
+
+"""
+    Rows of streamed feed queries are read as tuples from database cursor
+    and turned into dicts by column names computed once per query, only
+    dates and floats are converted to python values. Integer and text
+    values and aggregates are used as database driver returns them.
+    False reads rows by peewee .dicts(), slower, output is the same.
+"""
+FAST_ROWS = True
+
+"""
+    Precompressed copies of feeds written alongside plain xml files, so
+    webserver can serve them without compressing every request.
+    'gzip' writes feedname.xml.gz, 'zstd' writes feedname.xml.zst
+    (needs zstandard module). Feeds are always written into temporary
+    files renamed when feed is complete.
+"""
+COMPRESS = []
+COMPRESS_LEVEL = 6
+
+"""
+    Number of feeds exported in parallel, every worker thread uses its own
+    database connection. Category names needed by products feed are
+    loaded before workers start.
+    1 exports feeds one after another.
+"""
+WORKERS = 1
+
+"""
+    Incremental export. Only customers, products and orders changed since
+    the last run are exported and merged into feeds of the previous run.
+    Watermarks of the last run are kept in DELTA_STATE_FILE, keep it out of
+    OUTPUT_DIRECTORY. Feed is exported completely when its last full export
+    is older than DELTA_FULL_AFTER hours, this also drops records deleted
+    from database.
+    Changed products are found by Product.date_upd and by digests of their
+    stock, specific prices and combinations (price and attributes).
+    Product texts (product_lang) and category link_rewrite edited without
+    change of Product.date_upd are exported by the next full export.
+    Customers feed identifies customers by email, guest and registered
+    accounts with the same email are exported together when one of them
+    changes.
+"""
+DELTA = False
+DELTA_STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'delta_state.json')
+DELTA_FULL_AFTER = 24
+
+"""
+    Prices of products and variants are computed in batches of PRICE_BATCH
+    products. PRICE_BACKEND 'numpy' computes batch by vectorized numpy
+    operations (needs numpy module), 'python' computes prices one by one.
+    Both give the same prices.
+"""
+PRICE_BACKEND = 'python'
+PRICE_BATCH = 1000
+
+"""
+    Cache of serialized product records, sqlite file kept between runs.
+    Product whose data (product, texts, stock, variants, matched specific
+    prices, category and attribute names) didn't change is copied from
+    the cache without building and serializing it again.
+    Used by full exports of products feed, None disables the cache,
+    e.g. os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'record_cache.sqlite')
+"""
+RECORD_CACHE = None
+
+"""
+    Daemon mode, exporter.py --daemon exports feeds every DAEMON_INTERVAL
+    seconds. Before every run tables of every feed are probed by cheap
+    aggregate queries read from indexes (max id, max date_upd, the last
+    date_from/date_to of prices already passed, see exporter.py
+    --check-indexes), small tables (taxes, catalog price rules) by row
+    count and sums of prices too, and by information_schema update time,
+    feeds with unchanged tables are skipped. Changes in place and deletes
+    in big tables (stock quantities, prices of combinations and specific
+    prices) are found by update time only, servers not tracking it (e.g.
+    MariaDB InnoDB) export them at the latest after DAEMON_FORCE_AFTER
+    hours. DAEMON_PROBE_SUMS True probes these tables by row count and
+    sums of quantities and prices, every probe reads whole tables. Feed
+    is exported at least once per DAEMON_FORCE_AFTER hours.
+    Every run (cron or daemon) holds RUN_LOCK_FILE, run started while other
+    run is in progress exits.
+"""
+DAEMON_INTERVAL = 600
+DAEMON_FORCE_AFTER = 24
+DAEMON_PROBE_SUMS = False
+RUN_LOCK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'exporter.lock')
+
+"""
+    Checkpoints of customers, products and orders feeds. Every CHUNK_SIZE
+    records key of the last written record and size of partially written
+    feed files are saved into feedname.xml.checkpoint in output directory
+    of the first target. Failed export keeps partial files and the next
+    run continues after the saved key. Checkpoint older than
+    CHECKPOINT_MAX_AGE hours is ignored. Used by exports without DELTA.
+    Chunk query of STREAMING 'keyset' failed by connection error is
+    repeated up to RETRIES times, RETRY_BACKOFF seconds after the first
+    failure, doubled after every next one.
+"""
+CHECKPOINT = False
+CHECKPOINT_MAX_AGE = 6
+RETRIES = 3
+RETRY_BACKOFF = 1.0
+
+"""
+    Orders feed partitioned by month of order date_add. Every month is
+    written into orders-YYYY-MM.xml, orders.xml is joined from partition
+    files without reading database, only when content of a partition
+    changed. Months without orders have no partition. Only the last
+    ORDER_PARTITIONS months (the current one included) are exported by
+    every run, older partitions are exported once more when they leave
+    this window and then kept as they are. orders-manifest.json lists
+    partitions with their size, digest and export time, delete partition
+    file to export it again.
+    None exports orders.xml from all orders.
+"""
+ORDER_PARTITIONS = None
+
+"""
+    Number of processes rendering products feed. Products are split into
+    id_product ranges rendered by forked processes sharing data loaded
+    before (prices, taxes, stock, category and attribute names), shards
+    are joined in order into products.xml. Sharded export doesn't use
+    RECORD_CACHE and CHECKPOINT, every process uses its own database
+    connection. 1 renders products in exporting thread.
+    Processes are forked while no other thread runs, with WORKERS > 1
+    products feed is exported before worker threads start, other feeds
+    run in parallel after it.
+"""
+PRODUCT_PROCESSES = 1
+
+"""
+    XML builder of feed records by feed name.
+    'lxml' - lxml element tree serialized by lxml
+    'string' - light python records serialized by string writer,
+        output is identical, records are cheaper to build and write
+    Categories feed is always serialized directly by string writer.
+"""
+XML_BACKEND = {
+    'customer': 'string',
+    'product': 'string',
+    'order': 'string',
+}
+
+"""
+    Run report of every export: per feed and per stage times, row and query
+    counts, slow queries and peak memory. METRICS_REPORT is JSON file,
+    METRICS_PROMETHEUS is file for prometheus node_exporter textfile
+    collector (e.g. /var/lib/node_exporter/textfile_collector/samba.prom).
+    None disables the file. Queries running at least METRICS_SLOW_QUERY
+    seconds are logged in JSON report.
+"""
+METRICS_REPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'export_report.json')
+METRICS_PROMETHEUS = None
+METRICS_SLOW_QUERY = 1.0
+
 """
     Emulate SpecificPrice class, calculate discounted prices.
     If disabled, base prices without discounts will be exported.
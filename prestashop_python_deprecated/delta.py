@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+"""
+    incremental export support
+    (C) 2026 DiffSolutions s.r.o.
+    Licensed under CC BY-SA 4.0
+
+    * state file keeps per feed watermarks of last export
+    * changed records are merged into feed produced by previous run
+"""
+
+from lxml.etree import iterparse
+import hashlib
+import json
+import os
+
+def load_state(fname):
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+def save_state(fname, state):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, default = str, sort_keys = True)
+    os.replace(tmp, fname)
+
+def digest(obj):
+    """ stable hash of json serializable data """
+    data = json.dumps(obj, default = str, sort_keys = True)
+    return hashlib.sha1(data.encode('UTF-8')).hexdigest()
+
+def merge(prev, f, tag, key_tag, changed, removed = ()):
+    """
+        copy records (tag elements) of previous feed file prev into Feed f
+        records with key (text of key_tag) in changed are replaced by new
+        elements, all new elements of key are written in place of the
+        first old record with the key, other old records with the key are
+        dropped, records with key in removed are dropped, rest of changed
+        records is appended at the end
+
+        changed is dict key -> list of elements, ordered as records should
+        be appended
+    """
+    changed = dict(changed)
+    replaced = set()
+    for _, el in iterparse(prev, events = ('end',), tag = tag,
+                           huge_tree = True):
+        key = el.findtext(key_tag)
+        if key not in removed and key not in replaced:
+            new = changed.pop(key, None)
+            if new is None:
+                el.tail = None
+                f.write(el)
+            else:
+                replaced.add(key)
+                for new_el in new:
+                    f.write(new_el)
+        #free already processed records
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+    for els in changed.values():
+        for el in els:
+            f.write(el)
@@ -7,8 +7,15 @@
     Licensed under CC BY-SA 4.0
 
     * exporter exports prestashop data into configured directory.
-    * configuration is loaded from config.py
-    * first version, loads whole table into memory (sorry)
+    * configuration is loaded from config.py, shop settings from database
+      are resolved once into ShopContext (ctx argument of feeds)
+    * feeds of all TARGETS are exported in one pass, language independent
+      data are read once
+    * exporter.py --daemon exports feeds periodically and skips feeds
+      whose tables did not change, see DAEMON_INTERVAL
+    * big feeds are read in bounded memory if STREAMING is configured
+    * every run writes report with times of feeds and their stages,
+      see METRICS_REPORT
 """
 
 from model import Customer, Order, Product, ProductLang, GenderLang
@@ -17,20 +24,47 @@ from model import Tax, TaxRule, Image, SpecificPriceCondition
 from model import SpecificPriceConditionGroup, Address, SpecificPriceRule
 from model import Stock, ProductAttribute, ProductAttributeCombination
 from model import ProductCategory, Attribute, AttributeGroupLang, AttributeLang
-from config import SHOP_ID, LANG_ID, ORDER_CANCELLED, ORDER_FINISHED, PRICE_BUY
-from config import CATEGORY_URL_TEMPLATE, PRODUCT_URL_BASE, SHOP_GROUP_ID
-from config import COUNTRY_ID, IMAGE_URL_BASE, PS_SPECIFIC_PRICE_PRIORITY
-from config import OUTPUT_DIRECTORY, IMAGE_URL_TYPE, LANG
-from xml_writer import Feed
-from lxml.etree import Element, SubElement
+from model import ProductSupplier, FeatureProduct
+from model import OrderHistory, db, stream_db, shop_context, clear_settings
+from config import ORDER_CANCELLED, ORDER_FINISHED, PRICE_BUY
+from config import CATEGORY_URL_TEMPLATE, PRODUCT_URL_BASE
+from config import IMAGE_URL_BASE, IMAGE_URL_TYPE, TARGETS
+from config import STREAMING, CHUNK_SIZE, FAST_ROWS
+from config import DELTA, DELTA_STATE_FILE, DELTA_FULL_AFTER, WORKERS
+from config import XML_BACKEND, COMPRESS, COMPRESS_LEVEL
+from config import PRICE_BACKEND, PRICE_BATCH, RECORD_CACHE
+from config import METRICS_REPORT, METRICS_PROMETHEUS, METRICS_SLOW_QUERY
+from config import DAEMON_INTERVAL, DAEMON_FORCE_AFTER, RUN_LOCK_FILE
+from config import DAEMON_PROBE_SUMS
+from config import CHECKPOINT, CHECKPOINT_MAX_AGE, RETRIES, RETRY_BACKOFF
+from config import ORDER_PARTITIONS, PRODUCT_PROCESSES
+from xml_writer import Feed, Record, SubElement, leaf, serialize
+from record_cache import RecordCache
+from checkpoint import Checkpoint
+import delta
+import metrics
+import pricing
+import xml_writer
+from lxml import etree
+import argparse
 import collections
+import contextlib
+import fcntl
 import functools
+import hashlib
 import itertools
+import json
+import multiprocessing
 import operator
 import datetime
 import peewee
 import os.path
+import sys
+import threading
+import time
+import traceback
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
 
 def dt_iso(dt):
@@ -48,6 +82,12 @@ def order_state(state):
         return 'finished'
     return 'created'
 
+def record_factory(feed):
+    """ creates feed record elements, see XML_BACKEND in config.py """
+    if XML_BACKEND.get(feed) == 'string':
+        return Record
+    return etree.Element
+
 def parameter(p, name, val):
     if not val: #filter out zero and empty values
         return
@@ -65,35 +105,41 @@ def iseq_with_mask(a,b,mask):
     """
     return all((ai == bi) or not mi for ai,bi,mi in zip(a,b,mask))
 
-def load_specific_prices(dt):
+#zero date of MySQL, no date_from/date_to limit
+ZERO_DATE = '0000-00-00 00:00:00'
+
+def date_window(date_from, date_to, dt):
+    """ peewee expression, date dt is in open interval (date_from, date_to) """
+    return (date_from.is_null() | (date_from == ZERO_DATE) |
+            (date_from < dt)) & \
+           (date_to.is_null() | (date_to == ZERO_DATE) | (date_to > dt))
+
+def load_specific_prices(targets, dt):
+    """
+        specific prices of every target (ShopContext), read by one query,
+        prices of customers, groups, countries, carts and quantity discounts
+        are filtered out by database, see check_indexes
+    """
     def add_fltr(dct, pair):
         (k,v) = pair
         if v and v!='0' and not (type(v)==float and v == -1.0):
             dct[k] = v
         return dct
 
-    prices = []
+    prices = [[] for ctx in targets]
+    shops = sorted({0} | {ctx.shop_id for ctx in targets})
+    shop_groups = sorted({0} | {ctx.shop_group_id for ctx in targets})
     for sp in SpecificPrice.select()\
+              .where((SpecificPrice.id_cart == 0) &
+                     (SpecificPrice.id_customer == 0) &
+                     (SpecificPrice.id_group == 0) &
+                     (SpecificPrice.id_country == 0) &
+                     (SpecificPrice.from_quantity <= 1) &
+                     SpecificPrice.id_shop.in_(shops) &
+                     SpecificPrice.id_shop_group.in_(shop_groups) &
+                     date_window(SpecificPrice.date_from,
+                                 SpecificPrice.date_to, dt))\
               .order_by(SpecificPrice.id_specific_price_rule):
-        #print(sp.id_customer, sp.id_group, sp.id_country, sp.id_shop,
-        #      sp.id_shop_group, sp.id_cart)
-        if sp.id_customer != 0:
-            continue
-        if sp.id_group != 0:
-            continue
-        if sp.id_country != 0:
-            continue
-        if sp.id_shop not in {0, SHOP_ID}:
-            continue
-        if sp.id_shop_group not in {0, SHOP_GROUP_ID}:
-            continue
-        if sp.id_cart != 0:
-            continue
-        if sp.from_quantity > 1:
-            continue
-        if (sp.date_from and not (sp.date_from < dt)) or \
-            (sp.date_to and not (dt < sp.date_to)):
-            continue
         p = {}
         [add_fltr(p, v) for v in [
             ('id_shop', sp.id_shop),
@@ -103,53 +149,96 @@ def load_specific_prices(dt):
             ('id_customer', sp.id_customer),
             ('id_product', sp.id_product),
             ('id_product_attribute', sp.id_product_attribute),
+            ('id_specific_price_rule', sp.id_specific_price_rule),
             ('price', sp.price),
             ('reduction', sp.reduction),
             ('reduction_tax', sp.reduction_tax),
             ('reduction_type', sp.reduction_type),
             ]]
 
-        prices.append(p)
+        for ctx, target_prices in zip(targets, prices):
+            if sp.id_shop in {0, ctx.shop_id} and \
+                    sp.id_shop_group in {0, ctx.shop_group_id}:
+                target_prices.append(p)
     return prices
 
-def load_taxes():
-    taxes = {} #indexed by id_tax_group
-    for tax in Tax.select(Tax.rate, TaxRule.id_tax_rules_group)\
+#indexes used by filters of exporter queries, by model
+RECOMMENDED_INDEXES = {
+    SpecificPrice: [('id_cart', 'id_customer', 'id_group', 'id_country'),
+                    ('from',), ('to',)],
+    #max date_upd probed in daemon mode, see probe_table
+    Customer: [('date_upd',)],
+    Product: [('date_upd',)],
+}
+
+def check_indexes():
+    """
+        CREATE INDEX statements of RECOMMENDED_INDEXES missing in database,
+        existing index with the same leading columns is sufficient
+    """
+    statements = []
+    for model, recommended in RECOMMENDED_INDEXES.items():
+        table = model._meta.table_name
+        indexes = [tuple(index.columns) for index in db.get_indexes(table)]
+        for columns in recommended:
+            if any(index[:len(columns)] == columns for index in indexes):
+                continue
+            statements.append('CREATE INDEX samba_{} ON {} ({});'.format(
+                columns[0], table, ', '.join('`{}`'.format(column)
+                                             for column in columns)))
+    return statements
+
+def load_taxes(targets):
+    """ taxes of every target indexed by id_tax_group """
+    taxes = collections.defaultdict(dict) #indexed by id_country
+    countries = sorted({ctx.country_id for ctx in targets})
+    for tax in Tax.select(Tax.rate, TaxRule.id_tax_rules_group,
+                          TaxRule.id_country)\
                .join(TaxRule, on = (Tax.id_tax == TaxRule.id_tax)) \
-               .where(TaxRule.id_country == COUNTRY_ID).dicts():
-        taxes[tax['id_tax_rules_group']] = tax['rate'] /100 #rate is in percents * 100
-    return taxes
+               .where(TaxRule.id_country.in_(countries)).dicts():
+        taxes[tax['id_country']][tax['id_tax_rules_group']] = \
+                tax['rate'] /100 #rate is in percents * 100
+    return [taxes[ctx.country_id] for ctx in targets]
 
 def load_conditions():
-    conds = collections.defaultdict(list)
+    """
+        condition groups of catalog price rules by id_specific_price_rule,
+        group is sorted list of (type, value) conditions, all of them must
+        match
+    """
+    groups = collections.defaultdict(lambda: collections.defaultdict(list))
     for cond in SpecificPriceCondition.select(SpecificPriceCondition, SpecificPriceConditionGroup).join(SpecificPriceConditionGroup,
         on=(SpecificPriceCondition.id_specific_price_rule_condition_group ==
             SpecificPriceConditionGroup.id_specific_price_rule_condition_group)).dicts():
         rule = cond['id_specific_price_rule']
-        typ = cond['typ']
-        val = cond['value']
-        conds[rule].append((typ, val))
-    return conds
+        group = cond['id_specific_price_rule_condition_group']
+        groups[rule][group].append((cond['typ'], int(cond['value'])))
+    return {rule: [sorted(conds) for group, conds in sorted(rule_groups.items())]
+            for rule, rule_groups in groups.items()}
 
-def load_specific_price_rules(dt):
+def load_specific_price_rules(targets, dt):
+    """
+        catalog price rules of every target, ordered by id
+        rule without condition groups applies to all products
+    """
     def add_fltr(dct, pair):
         (k,v) = pair
         if v and v!='0' and not (type(v)==float and v == -1.0):
             dct[k] = v
         return dct
-    rules = []
-    for rule in SpecificPriceRule.select().join(SpecificPriceConditionGroup)\
-                .where(SpecificPriceRule.from_quantity <= 1):
-
-        if (rule.date_from and not (rule.date_from < dt)) or \
-            (rule.date_to and not (dt < rule.date_to)):
-            continue
-        if rule.id_country != 0:
-            continue
-        if rule.id_shop not in {0, SHOP_ID}:
-            continue
+    rules = [[] for ctx in targets]
+    shops = sorted({0} | {ctx.shop_id for ctx in targets})
+    conditions = load_conditions()
+    for rule in SpecificPriceRule.select()\
+                .where((SpecificPriceRule.from_quantity <= 1) &
+                       (SpecificPriceRule.id_country == 0) &
+                       SpecificPriceRule.id_shop.in_(shops) &
+                       date_window(SpecificPriceRule.date_from,
+                                   SpecificPriceRule.date_to, dt))\
+                .order_by(SpecificPriceRule.id_specific_price_rule):
         r = {}
         [add_fltr(r, v) for v in [
+            ('id_specific_price_rule', rule.id_specific_price_rule),
             ('name', rule.name),
             ('id_shop', rule.id_shop),
             ('id_currency', rule.id_currency),
@@ -160,54 +249,418 @@ def load_specific_price_rules(dt):
             ('reduction_tax', rule.reduction_tax),
             ('reduction_type', rule.reduction_type),
             ]]
-        cgs = list(iter(rule.conditiongroups))
-        cg_list = []
-        for cg in cgs:
-            cond_dict = {}
-            for cond in cg.conditions:
-                cond_dict[cond.typ] = cond.value
-            if cond_dict: #empty conditions list means 'true'
-                cg_list.append(cond_dict)
-        add_fltr(r, ('condition_groups', cg_list))
-        rules.append(r)
+        #empty conditions list means 'true'
+        add_fltr(r, ('condition_groups',
+                     conditions.get(rule.id_specific_price_rule, [])))
+        for ctx, target_rules in zip(targets, rules):
+            if rule.id_shop in {0, ctx.shop_id}:
+                target_rules.append(r)
     return rules
 
-def load_product_categories():
-    prod_cat = collections.defaultdict(list)
-    cat_prod = collections.defaultdict(list)
-    for pc in ProductCategory.select():
-        prod = pc.id_product
-        cat = pc.id_category
-        prod_cat[prod].append(cat)
-        cat_prod[cat].append(prod)
-    return (prod_cat, cat_prod)
-
-def load_attributes():
-    id_val = {}
-    id_name = {}
+def load_rule_members(rules):
+    """
+        products matching conditions of catalog price rules of all
+        targets, {(type, value): set of id_product}, values of 'attribute'
+        conditions are sets of (id_product, id_product_attribute)
+        only values used by rules are read
+    """
+    values = collections.defaultdict(set)
+    for target_rules in rules:
+        for rule in target_rules:
+            for group in rule.get('condition_groups', ()):
+                for typ, value in group:
+                    values[typ].add(value)
+    members = collections.defaultdict(set)
+    if values['category']:
+        for row in ProductCategory.select(ProductCategory.id_product,
+                                          ProductCategory.id_category)\
+                .where(ProductCategory.id_category.in_(
+                    sorted(values['category']))).tuples():
+            members[('category', row[1])].add(row[0])
+    if values['manufacturer']:
+        for row in Product.select(Product.id_product, Product.id_manufacturer)\
+                .where(Product.id_manufacturer.in_(
+                    sorted(values['manufacturer']))).tuples():
+            members[('manufacturer', row[1])].add(row[0])
+    if values['supplier']:
+        for row in ProductSupplier.select(ProductSupplier.id_product,
+                                          ProductSupplier.id_supplier)\
+                .where(ProductSupplier.id_supplier.in_(
+                    sorted(values['supplier']))).tuples():
+            members[('supplier', row[1])].add(row[0])
+    if values['feature']:
+        for row in FeatureProduct.select(FeatureProduct.id_product,
+                                         FeatureProduct.id_feature_value)\
+                .where(FeatureProduct.id_feature_value.in_(
+                    sorted(values['feature']))).tuples():
+            members[('feature', row[1])].add(row[0])
+    if values['attribute']:
+        for row in ProductAttribute.select(ProductAttribute.id_product,
+                    ProductAttribute.id_product_attribute,
+                    ProductAttributeCombination.id_attribute)\
+                .join(ProductAttributeCombination, on = (
+                    ProductAttribute.id_product_attribute ==
+                    ProductAttributeCombination.id_product_attribute))\
+                .where(ProductAttributeCombination.id_attribute.in_(
+                    sorted(values['attribute']))).tuples():
+            members[('attribute', row[2])].add((row[0], row[1]))
+    return dict(members)
+
+def load_stock(targets):
+    """
+        (product stock by id_product, variant stock by id_product and
+        id_product_attribute) of every target, stock of all products and
+        variants is read in one query
+    """
+    stock = collections.defaultdict(dict) #indexed by id_shop
+    #indexed by id_shop, id_product
+    variant_stock = collections.defaultdict(lambda:
+                                            collections.defaultdict(dict))
+    shops = sorted({ctx.shop_id for ctx in targets})
+    for row in Stock.select(Stock.id_product, Stock.id_product_attribute,
+                            Stock.id_shop, Stock.quantity)\
+               .where(Stock.id_shop.in_(shops)).tuples():
+        id_product, id_product_attribute, id_shop, quantity = row
+        if id_product_attribute == 0:
+            stock[id_shop][id_product] = quantity
+        else:
+            variant_stock[id_shop][id_product][id_product_attribute] = \
+                    quantity
+    return [(stock[ctx.shop_id], dict(variant_stock[ctx.shop_id]))
+            for ctx in targets]
+
+def load_attributes(targets):
+    """ (attribute group names, attribute values) of every target """
+    id_val = collections.defaultdict(dict) #indexed by id_lang
+    id_name = collections.defaultdict(dict)
+    langs = sorted({ctx.lang_id for ctx in targets})
     for attr in Attribute.select(Attribute, AttributeLang, AttributeGroupLang)\
             .join(AttributeLang, on=Attribute.id_attribute ==
                     AttributeLang.id_attribute)\
-            .join(AttributeGroupLang, on=Attribute.id_attribute_group ==
-                    AttributeGroupLang.id_attribute_group)\
-            .where(AttributeLang.id_lang == LANG_ID &
-                    AttributeGroupLang.id_lang == LANG_ID).dicts():
+            .join(AttributeGroupLang, on=(Attribute.id_attribute_group ==
+                    AttributeGroupLang.id_attribute_group) &
+                    (AttributeGroupLang.id_lang == AttributeLang.id_lang))\
+            .where(AttributeLang.id_lang.in_(langs)).dicts():
         attr_id = attr['id_attribute']
         grp = attr['public_name']
         val = attr['name']
-        id_val[attr_id] = val
-        id_name[attr_id] = grp
-    return (id_name, id_val)
+        id_val[attr['id_lang']][attr_id] = val
+        id_name[attr['id_lang']][attr_id] = grp
+    return [(id_name[ctx.lang_id], id_val[ctx.lang_id]) for ctx in targets]
+
+
+def retry(read):
+    """
+        result of read(), read is called again after connection error,
+        see RETRIES in config.py
+    """
+    for attempt in itertools.count():
+        try:
+            return read()
+        except (peewee.OperationalError, peewee.InterfaceError) as e:
+            if attempt >= RETRIES:
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt
+            print("database error {}, retrying in {}s".format(e, delay),
+                  file = sys.stderr)
+            metrics.retried()
+            try:
+                db.close()
+            except Exception:
+                pass #connection is broken already
+            time.sleep(delay)
+
+
+#fields whose python_value only repeats conversion done by database driver
+NATIVE_FIELDS = (peewee.IntegerField, peewee.BigIntegerField,
+                 peewee.SmallIntegerField, peewee.AutoField,
+                 peewee.CharField, peewee.TextField)
+FETCH_ROWS = 1000 #rows fetched from cursor at once by fetch_rows
+
+def native_field(field):
+    if type(field) is peewee.ForeignKeyField:
+        field = field.rel_field
+    return type(field) in NATIVE_FIELDS
+
+
+def row_keys(query):
+    """
+        dict keys of query rows, names of selected fields and aliases,
+        repeated names get suffix _2, _3... the same as in query.dicts()
+    """
+    keys = []
+    seen = {}
+    for node in query.selected_columns:
+        key = node.name
+        while key in seen:
+            seen[key] += 1
+            key = '{}_{}'.format(key, seen[key])
+        seen[key] = 1
+        keys.append(key)
+    return keys
+
+
+def fetch_rows(query, database = None):
+    """
+        iterate over query results as dicts, the same as query.dicts()
+        without per row processing of peewee, sql of query is executed
+        and tuples fetched from cursor are zipped with keys computed once,
+        only values of fields not in NATIVE_FIELDS (dates, floats) are
+        converted by python_value of the field
+    """
+    convert = []
+    for i, node in enumerate(query.selected_columns):
+        field = node.unwrap()
+        if isinstance(field, peewee.Field) and not native_field(field):
+            convert.append((i, field.python_value))
+    as_dict = functools.partial(zip, row_keys(query))
+    cursor = (database or db).execute_sql(*query.sql())
+    try:
+        while True:
+            rows = cursor.fetchmany(FETCH_ROWS)
+            if not rows:
+                return
+            if convert:
+                rows = [list(row) for row in rows]
+                for row in rows:
+                    for i, python_value in convert:
+                        row[i] = python_value(row[i])
+            yield from map(dict, map(as_dict, rows))
+    finally:
+        cursor.close()
+
+
+def stream(query, key):
+    """
+        iterate over query results as dicts, query has to be ordered by key
+        (peewee field), see STREAMING in config.py
+
+        keyset pagination reads CHUNK_SIZE rows with key above the last
+        one, the last key of a full chunk may continue in the next chunk,
+        so its rows are read completely by separate query, every chunk
+        is read again if connection fails
+
+        rows are read by fetch_rows, see FAST_ROWS in config.py
+    """
+    query = query.dicts()
+    if FAST_ROWS:
+        rows = fetch_rows
+    else:
+        rows = lambda query, database = None: query.iterator(database)
+    if STREAMING == 'cursor':
+        database = stream_db()
+        try:
+            yield from rows(query, database)
+        finally:
+            database.close()
+    elif STREAMING == 'keyset':
+        last = None
+        while True:
+            chunk = query if last is None else query.where(key > last)
+            chunk_rows = retry(lambda: list(rows(chunk.limit(CHUNK_SIZE))))
+            if len(chunk_rows) < CHUNK_SIZE:
+                yield from chunk_rows
+                return
+            last = chunk_rows[-1][key.name]
+            yield from (row for row in chunk_rows if row[key.name] != last)
+            yield from retry(lambda: list(rows(query.where(key == last))))
+    else:
+        yield from rows(query)
+
+
+def load_variants(cond = None):
+    """
+        all product variants in one query, ordered by id_product
+        rows are streamed, use GroupCursor to merge them with products
+        cond (peewee expression on Product) limits products
+    """
+    query = ProductAttribute.select(ProductAttribute,
+                ProductAttributeCombination).join(
+                        ProductAttributeCombination, on = (
+                        ProductAttribute.id_product_attribute ==
+                        ProductAttributeCombination.id_product_attribute))\
+                        .order_by(ProductAttribute.id_product,
+                                  ProductAttributeCombination.id_product_attribute,
+                                  ProductAttributeCombination.id_attribute)
+    if cond is not None:
+        query = query.where(ProductAttribute.id_product.in_(
+            Product.select(Product.id_product).where(cond)))
+    return stream(query, ProductAttribute.id_product)
+
+
+def load_order_items(cond = None):
+    """
+        all order items in one query, ordered by id_order
+        rows are streamed, use GroupCursor to merge them with orders
+        cond (peewee expression on Order) limits orders
+    """
+    query = OrderDetail.select().order_by(OrderDetail.id_order,
+                                          OrderDetail.id_order_detail)
+    if cond is not None:
+        query = query.where(OrderDetail.id_order.in_(
+            Order.select(Order.id_order).where(cond)))
+    return stream(query, OrderDetail.id_order)
+
+
+class GroupCursor(object):
+    """
+        walks rows ordered by key in step with another stream ordered by
+        the same key. get(k) returns list of rows for key k, keys have to be
+        requested in ascending order.
+    """
+    def __init__(self, rows, key):
+        self.groups = itertools.groupby(rows, key = key)
+        self.current = next(self.groups, None)
+
+    def get(self, k):
+        while self.current is not None and self.current[0] < k:
+            self.current = next(self.groups, None)
+        if self.current is None or self.current[0] != k:
+            return []
+        rows = list(self.current[1])
+        self.current = next(self.groups, None)
+        return rows
+
 
+def match_attr(a, b, attr):
+    a1 = a.get(attr)
+    b1 = b.get(attr)
+    #print("match_attr {}: {}, {}".format(attr,a1, b1))
+    return b1==0 or b1==None or a1==b1
 
-def specific_price(product, dt, prices, taxes, rules, prod_cat, cat_prod,
-        add_price = 0):
-    def match_attr(a, b, attr):
-        a1 = a.get(attr)
-        b1 = b.get(attr)
-        #print("match_attr {}: {}, {}".format(attr,a1, b1))
-        return b1==0 or b1==None or a1==b1
+def match_rule(a,b):
+    all_attrs = {'id_cart', 'id_product', 'id_currency', 'id_country',
+                'id_group', 'id_customer', 'id_product_attribute'}
+    matches = all(match_attr(a,b,attr) for attr in all_attrs)
+    #if matches:
+    #    print("MATCH: rule {} matched for product {}" \
+    #          .format(b,a.get('id_product')))
+    return matches
 
+
+def price_priority(ctx):
+    """
+        score weights of PS_SPECIFIC_PRICE_PRIORITIES of ctx as in
+        prestashop SpecificPrice::_getScoreQuery, [(field, value, weight)]
+        value of customer, currency and group is 0 (visitor)
+    """
+    fields = ['id_customer'] + ctx.ps_specific_price_priority.split(';')
+    values = {'id_shop': ctx.shop_id, 'id_country': ctx.country_id}
+    return [(field, values.get(field, 0), 2 ** (k + 1))
+            for k, field in enumerate(reversed(fields)) if field]
+
+
+class SpecificPriceIndex(object):
+    """
+        specific prices indexed by (id_product, id_product_attribute),
+        None in the key is a wildcard (rule value 0 or missing), and
+        catalog price rules compiled into prices by id_product and by
+        (id_product, id_product_attribute), see compile().
+        Prices are ordered as prestashop orders them: combination prices
+        first, then by id_specific_price_rule (prices set by hand first)
+        and by PS_SPECIFIC_PRICE_PRIORITIES score of ctx.
+        match() returns the same price as the first match of linear scan
+        over ordered prices, but looks only into four buckets and rule
+        prices of the product.
+    """
+    def __init__(self, prices, ctx, rules = (), members = None):
+        self.priority = price_priority(ctx)
+        self.buckets = collections.defaultdict(list)
+        for pos, price in enumerate(prices):
+            key = (self.key(price.get('id_product')),
+                   self.key(price.get('id_product_attribute')))
+            self.buckets[key].append((self.order(price, pos), price))
+        for bucket in self.buckets.values():
+            bucket.sort(key = operator.itemgetter(0))
+        self.all_rules = []
+        self.product_rules = collections.defaultdict(list)
+        self.variant_rules = collections.defaultdict(list)
+        self.compile(rules, members or {})
+
+    @staticmethod
+    def key(val):
+        if val==0 or val==None:
+            return None
+        return val
+
+    def order(self, price, pos = 0, variant = False):
+        """ sort key of price, the lowest wins """
+        score = sum(weight for field, value, weight in self.priority
+                    if (price.get(field) or 0) == value)
+        return (not (variant or price.get('id_product_attribute')),
+                price.get('id_specific_price_rule', 0), -score, pos)
+
+    def compile(self, rules, members):
+        """
+            resolve condition groups of catalog price rules into rule
+            prices of matching products (groups are OR-ed, conditions in
+            group are AND-ed), members - see load_rule_members
+        """
+        for pos, rule in enumerate(rules):
+            price = {k: v for k, v in rule.items() if k != 'condition_groups'}
+            if not match_rule({}, price):
+                continue #rule of currency, country or group
+            groups = rule.get('condition_groups')
+            if not groups:
+                self.all_rules.append((self.order(price, pos), price))
+                continue
+            products = set()
+            variants = set()
+            for group in groups:
+                group_products = None
+                group_variants = None
+                for typ, value in group:
+                    ids = members.get((typ, value), set())
+                    if typ == 'attribute':
+                        group_variants = ids if group_variants is None \
+                                else group_variants & ids
+                    else:
+                        group_products = ids if group_products is None \
+                                else group_products & ids
+                if group_variants is None:
+                    products |= group_products
+                else:
+                    variants |= {v for v in group_variants
+                                 if group_products is None or
+                                 v[0] in group_products}
+            order = self.order(price, pos)
+            for pid in products:
+                self.product_rules[pid].append((order, price))
+            order = self.order(price, pos, variant = True)
+            for v in variants:
+                self.variant_rules[v].append((order, price))
+        self.all_rules.sort(key = operator.itemgetter(0))
+
+    def match(self, product, id_product_attribute = None):
+        """ best price of product or its combination id_product_attribute """
+        if id_product_attribute:
+            product = dict(product,
+                           id_product_attribute = id_product_attribute)
+        pid = product.get('id_product')
+        paid = product.get('id_product_attribute')
+        best = None
+        for key in {(pid, paid), (pid, None), (None, paid), (None, None)}:
+            for order, price in self.buckets.get(key, ()):
+                if best is not None and order > best[0]:
+                    break
+                if match_rule(product, price):
+                    best = (order, price)
+                    break
+        #rule prices are sorted by rule, the first one is the best
+        for candidates in (self.all_rules, self.product_rules.get(pid),
+                           self.variant_rules.get((pid, paid))):
+            if candidates and (best is None or candidates[0][0] < best[0]):
+                best = candidates[0]
+        return best[1] if best else None
+
+
+def specific_price(product, prices, taxes, add_price = 0,
+        id_product_attribute = None):
+    """
+        (price, price before discount) with tax of product or its
+        combination, prices - SpecificPriceIndex with catalog price rules
+        feeds compute prices in batches, see add_prices and pricing module
+    """
     def calc_tax(price, tax):
         price = price * (1 + tax)
         return price
@@ -230,19 +683,6 @@ def specific_price(product, dt, prices, taxes, rules, prod_cat, cat_prod,
         raise NotImplemented("reduction type {} is not "
                              "implemented/supported".format(sp['reduction_type']))
 
-    def match_rule(a,b):
-        all_attrs = {'id_cart', 'id_product', 'id_currency', 'id_country',
-                    'id_group', 'id_customer', 'id_product_attribute'}
-        matches = all(match_attr(a,b,attr) for attr in all_attrs)
-        cgroup = b.get('condition_group')
-        if matches and cgroup:
-            #TODO:matching cgroup
-            matches = False
-        #if matches:
-        #    print("MATCH: rule {} matched for product {}" \
-        #          .format(b,a.get('id_product')))
-        return matches
-
     id_specific_price_rule = 0
     reduction_tax = 1
     price = product['price'] + add_price
@@ -251,19 +691,52 @@ def specific_price(product, dt, prices, taxes, rules, prod_cat, cat_prod,
     if tax is None:
         raise ValueError("missing tax info for product id "
                          "{}".format(product['id_product']))
-    matches = [price for price in prices #+rules
-                if match_rule(product, price)]
-    #attrs = PS_SPECIFIC_PRICE_PRIORITY.split(";")
-    #attr_getter = lambda x:[x.get(a) for a in attrs]
-    #attrs = sorted(attrs, key = attr_getter)
-    if matches:
-        price = sale(product, matches[0], tax, add_price) #calculate sale + tax
+    match = prices.match(product, id_product_attribute)
+    if match is not None:
+        price = sale(product, match, tax, add_price) #calculate sale + tax
     else:
         price = calc_tax(price, tax) #calculate tax by default
     price2 = calc_tax(price_before, tax)
     #print("tax: {} resulting price: {}".format(tax, price))
     return (price, price2)
 
+def match_prices(product, variants, prices, taxes):
+    """
+        (tax, specific prices) of product, specific prices of product and
+        of its variants with price of combination are in the order
+        product_record uses them, None if no specific price applies
+        prices - SpecificPriceIndex
+    """
+    tax = taxes.get(product['id_tax_rules_group'])
+    if tax is None:
+        raise ValueError("missing tax info for product id "
+                         "{}".format(product['id_product']))
+    matches = [prices.match(product)]
+    for id_product_attr, group in variants:
+        if group[0].get('price'):
+            matches.append(prices.match(product, id_product_attr))
+    return tax, matches
+
+def add_prices(batch, product, variants, tax, matches):
+    """
+        add prices of product into PriceBatch, see match_prices, returns
+        indexes of product and variant prices in batch, variants with the
+        same price of combination and specific price share one price
+    """
+    indexes = [batch.add(product['price'], tax, matches[0])]
+    matches = iter(matches[1:])
+    memo = {} #index by (price of combination, id of specific price)
+    for id_product_attr, group in variants:
+        add_price = group[0].get('price')
+        if add_price:
+            match = next(matches)
+            key = (add_price, id(match))
+            if key not in memo:
+                memo[key] = batch.add(product['price'] + add_price, tax,
+                                      match)
+            indexes.append(memo[key])
+    return indexes
+
 def img_url(img_id, link_rewrite):
     if IMAGE_URL_TYPE == 'dirs':
         dirs = list(str(img_id))
@@ -271,264 +744,1253 @@ def img_url(img_id, link_rewrite):
     else:
         return os.path.join(IMAGE_URL_BASE, "{}-large_default".format(img_id), link_rewrite + '.jpg')
 
-def product_url(product, variant_id = None):
+def url_file(product, product_id):
+    """ file name of product or variant URL """
+    return "{}-{}.html".format(product_id, product.get('link_rewrite'))
+
+def product_url(ctx, product, variant_id = None):
     product_id = product.get('id_product', '')
     if variant_id:
         product_id = variant_id
     return urljoin(PRODUCT_URL_BASE, 
-            "/".join((LANG,
+            "/".join((ctx.lang,
             product.get('cat_link_rewrite', ''),
-            "{}-{}.html".format(product_id,
-                product.get('link_rewrite')))))
+            url_file(product, product_id))))
+
+def product_urls(ctx, product):
+    """
+        (product URL, prefix of variant URLs), URL is joined once per
+        product, variant URL is the prefix with variant file name,
+        prefix is None if urljoin doesn't keep file name as it is
+    """
+    url = product_url(ctx, product)
+    fname = url_file(product, product.get('id_product', ''))
+    if not url.endswith(fname):
+        return url, None
+    return url, url[:-len(fname)]
 
-customer_email = {}
 b64 = lambda s: b64encode(s.encode('UTF-8'))
-with Feed('customer', os.path.join(OUTPUT_DIRECTORY, 'customers.xml'), 'CUSTOMERS') as f:
-    for customer in Customer.select(Customer, GenderLang.name,
-                                    Address.postcode, Address.phone,
-                                    Address.phone_mobile,
-                                    peewee.fn.min(Address.id_address).alias('min_id')).join(GenderLang) \
+
+def shared(records, targets):
+    """ the same element for every target """
+    for el in records:
+        yield [el] * len(targets)
+
+
+def load_genders(targets):
+    """ gender names of every target by id_gender """
+    genders = collections.defaultdict(dict) #indexed by id_lang
+    langs = sorted({ctx.lang_id for ctx in targets})
+    for gender in GenderLang.select().where(GenderLang.id_lang.in_(langs))\
+            .dicts():
+        genders[gender['id_lang']][gender['id_gender']] = gender['name']
+    return [genders[ctx.lang_id] for ctx in targets]
+
+
+def customer_record(Element, customer, gender):
+    el = Element("CUSTOMER")
+    i = SubElement(el, "FIRST_NAME")
+    i.text = customer['firstname']
+    i = SubElement(el, "LAST_NAME")
+    i.text = customer['lastname']
+    i = SubElement(el, "CUSTOMER_ID")
+    #i.text = str(customer['id_customer'])
+    i.text = b64(str(customer['email']))
+    i = SubElement(el, "EMAIL")
+    i.text = customer['email']
+    phone = customer.get('phone_mobile') or customer.get('phone')
+    if phone:
+        i = SubElement(el, "PHONE")
+        i.text = phone
+    zip_code = customer.get('postcode')
+    if zip_code:
+        i = SubElement(el, "ZIP_CODE")
+        i.text = zip_code
+    i = SubElement(el, "NEWSLETTER_FREQUENCY")
+    i.text = "every day" if customer['newsletter'] else "never"
+    i = SubElement(el, "REGISTRATION")
+    i.text  = dt_iso(customer['date_add'])
+    par = SubElement(el, "PARAMETERS")
+    parameter(par, "Birthday", dt_iso(customer['birthday']))
+    parameter(par, "Optin", customer['optin'])
+    parameter(par, "Deleted", customer['deleted'])
+    parameter(par, "Gender", gender)
+    return el
+
+
+def customer_records(targets, cond = None, checkpoint = None):
+    """
+        CUSTOMER elements of every target ordered by id_customer, yields
+        list of elements by target, None if customer has no gender name
+        in target language, customers without any element are skipped.
+        Customers are read once, targets with the same gender name share
+        element.
+        cond (peewee expression) limits exported customers
+        checkpoint - Checkpoint, its key is set to id_customer of yielded
+            customer
+    """
+    Element = record_factory('customer')
+    genders = load_genders(targets)
+    query = Customer.select(Customer,
+                            Address.postcode, Address.phone,
+                            Address.phone_mobile,
+                            peewee.fn.min(Address.id_address).alias('min_id')) \
             .join(Address, on=(Customer.id_customer ==
                 Address.id_customer)) \
-            .where(GenderLang.id_lang == LANG_ID) \
             .group_by(Address.id_customer) \
-            .dicts():
-        el = Element("CUSTOMER")
-        i = SubElement(el, "FIRST_NAME")
-        i.text = customer['firstname']
-        i = SubElement(el, "LAST_NAME")
-        i.text = customer['lastname']
-        i = SubElement(el, "CUSTOMER_ID")
-        #i.text = str(customer['id_customer'])
-        i.text = b64(str(customer['email']))
-        i = SubElement(el, "EMAIL")
-        i.text = customer['email']
-        phone = customer.get('phone_mobile') or customer.get('phone')
-        if phone:
-            i = SubElement(el, "PHONE")
-            i.text = phone
-        zip_code = customer.get('postcode')
-        if zip_code:
-            i = SubElement(el, "ZIP_CODE")
-            i.text = zip_code
-        i = SubElement(el, "NEWSLETTER_FREQUENCY")
-        i.text = "every day" if customer['newsletter'] else "never"
-        i = SubElement(el, "REGISTRATION")
-        i.text  = dt_iso(customer['date_add'])
-        par = SubElement(el, "PARAMETERS")
-        parameter(par, "Birthday", dt_iso(customer['birthday']))
-        parameter(par, "Optin", customer['optin'])
-        parameter(par, "Deleted", customer['deleted'])
-        parameter(par, "Gender", customer['name'])
-        f.write(el)
-        customer_email[customer['id_customer']] = customer['email']
-
-
-with Feed('category', os.path.join(OUTPUT_DIRECTORY, 'categories.xml'), 'CATEGORIES') as f:
-    root_id = None
-    nodes = {}
-    subcats = collections.defaultdict(list)
-    global cat_names
-    cat_names = {}
-
-    def subtree(node_id, cattext = ""):
-        global cat_names
-        node = nodes[node_id]
-        subnodes = subcats[node_id]
-        title = node.findtext('TITLE', default = 'None')
-        if cattext:
-            name = cattext + ' | ' + title
-        else:
-            name = title
-        cat_names[node_id] = name
-        for subnode in subnodes:
-            node.append(nodes[subnode])
-            subtree(subnode, name)
+            .order_by(Customer.id_customer)
+    if cond is not None:
+        query = query.where(cond)
+    for customer in stream(query, Customer.id_customer):
+        names = [target_genders.get(customer['gender'])
+                 for target_genders in genders]
+        if not any(names):
+            continue
+        els = {name: customer_record(Element, customer, name)
+               for name in set(names) if name is not None}
+        if checkpoint is not None:
+            checkpoint.key = customer['id_customer']
+        yield [els.get(name) for name in names]
+
 
+cat_names = {} #category names with path by ShopContext
+
+def load_category_tree(ctx):
+    """
+        (root id_category, child ids by id_category, name by id_category)
+        of categories of ctx, children are in order of id_category
+    """
+    root_id = None
+    children = collections.defaultdict(list)
+    titles = {}
     custom_order = peewee.Case(CategoryLang.id_lang, [
-            (LANG_ID, 100),
+            (ctx.lang_id, 100),
             (0, 99),
             ], -1000)
-    for category in Category.select(Category, CategoryLang.name,
-            peewee.fn.max(custom_order)).join(CategoryLang, on = (Category.id_category ==
-                                            CategoryLang.id_category)) \
-            .where(CategoryLang.id_lang == LANG_ID and \
-            CategoryLang.id_shop == SHOP_ID).group_by(Category.id_category).dicts():
-        #print(category)
-        node = Element("ITEM")
-        node_id = category['id_category']
-        i = SubElement(node, "URL")
-        i.text = CATEGORY_URL_TEMPLATE.format(id_category =
-                                              category['id_category'])
-        i = SubElement(node, "TITLE")
-        i.text = category['name']
-        subcats[category['id_parent']].append(node_id)
-        nodes[node_id] = node
-        if category['is_root_category']:
+    for node_id, parent_id, name, is_root, order in Category.select(
+            Category.id_category, Category.id_parent, CategoryLang.name,
+            Category.is_root_category, peewee.fn.max(custom_order))\
+            .join(CategoryLang, on = (Category.id_category ==
+                                      CategoryLang.id_category)) \
+            .where((CategoryLang.id_lang == ctx.lang_id) &
+            (CategoryLang.id_shop == ctx.shop_id)).group_by(Category.id_category).tuples():
+        children[parent_id].append(node_id)
+        titles[node_id] = name
+        if is_root:
             if root_id is None:
-                root_id = category['id_category']
+                root_id = node_id
             else:
-                #print("More than one root for category tree, ignoring other.")
                 raise ValueError("More than one root for category tree")
     if not root_id:
         raise ValueError("Missing category tree root")
-    for node in subcats[root_id]:
-        subtree(node)
-        f.write(nodes[node])
-    #print(cat_names)
+    return root_id, children, titles
 
 
-with Feed('product', os.path.join(OUTPUT_DIRECTORY, 'products.xml'), 'PRODUCTS') as f:
-    dt_now = datetime.datetime.now()
-    specific_prices = load_specific_prices(dt_now)
-    taxes = load_taxes()
-    rules = load_specific_price_rules(dt_now)
-    prod_cat, cat_prod = load_product_categories()
-    attr_name, attr_val = load_attributes()
-    #print("loaded specific {} price rules + {} catalog price "
-    #      "rules ".format(len(specific_prices), len(rules)))
-    for product in Product.select(Product,
-                                  peewee.fn.min(Image.id_image).alias('image'),
-                                  ProductLang,
-                                  CategoryLang.link_rewrite\
-                                          .alias('cat_link_rewrite'),
-                                  Stock.quantity.alias('stock'))\
-                   .join(ProductLang).join(Image, on=(Product.id_product ==
-                                                      Image.id_product),
-                                           attr='image')\
-                   .join(Stock, on=(Stock.id_product ==
-                                    Product.id_product))\
+def walk_categories(root_id, children):
+    """
+        (id_category, id_parent) of categories under root in document
+        order, None instead of id_category closes the last open category,
+        every category is visited once even if tree has a cycle
+    """
+    seen = {root_id}
+    stack = [(node_id, root_id) for node_id in reversed(children[root_id])]
+    while stack:
+        node_id, parent_id = stack.pop()
+        if node_id is None:
+            yield None, parent_id
+            continue
+        if node_id in seen:
+            continue
+        seen.add(node_id)
+        yield node_id, parent_id
+        stack.append((None, node_id))
+        stack.extend((child, node_id) for child in reversed(children[node_id]))
+
+
+def category_paths(root_id, children, titles):
+    """ "A | B | C" names with path of categories under root by id """
+    names = {}
+    for node_id, parent_id in walk_categories(root_id, children):
+        if node_id is None:
+            continue
+        #lxml findtext gives '' for TITLE without text
+        title = titles[node_id] or ''
+        cattext = names.get(parent_id)
+        names[node_id] = cattext + ' | ' + title if cattext else title
+    return names
+
+
+def category_names(ctx):
+    """ category names with path of ctx, loaded once into cat_names """
+    if ctx not in cat_names:
+        cat_names[ctx] = category_paths(*load_category_tree(ctx))
+    return cat_names[ctx]
+
+
+def category_feed(ctx):
+    """
+        top level category ITEM elements with nested subcategories,
+        serialized into bytes one top level category at a time, fills
+        cat_names of ctx
+    """
+    root_id, children, titles = load_category_tree(ctx)
+    cat_names[ctx] = category_paths(root_id, children, titles)
+    out = []
+    depth = 0
+    for node_id, parent_id in walk_categories(root_id, children):
+        if node_id is None:
+            out.append('</ITEM>')
+            depth -= 1
+            if not depth:
+                yield ''.join(out).encode('ascii', 'xmlcharrefreplace')
+                out = []
+            continue
+        depth += 1
+        out.append('<ITEM>' + leaf('URL', CATEGORY_URL_TEMPLATE.format(
+                id_category = node_id)) + leaf('TITLE', titles[node_id]))
+
+
+@metrics.stage('lookups')
+def load_product_lookups(targets, dt):
+    """
+        data shared by all products of every target, loaded before products
+        feed, every table is read once for all targets
+    """
+    for ctx in targets:
+        category_names(ctx)
+    specific_prices = load_specific_prices(targets, dt)
+    taxes = load_taxes(targets)
+    rules = load_specific_price_rules(targets, dt)
+    stock = load_stock(targets)
+    rule_members = load_rule_members(rules)
+    attributes = load_attributes(targets)
+    lookups = []
+    for i in range(len(targets)):
+        lookups.append({'dt': dt,
+                        'specific_prices': specific_prices[i],
+                        'taxes': taxes[i],
+                        'rules': rules[i],
+                        'stock': stock[i][0],
+                        'variant_stock': stock[i][1],
+                        'rule_members': rule_members,
+                        'attr_name': attributes[i][0],
+                        'attr_val': attributes[i][1]})
+    return lookups
+
+
+def load_product_texts(ctx, cond = None):
+    """
+        product texts in language of ctx ordered by id_product
+        rows are streamed, use GroupCursor to merge them with products
+        cond (peewee expression on Product) limits products
+    """
+    query = Product.select(Product.id_product, ProductLang.name,
+                           ProductLang.description, ProductLang.link_rewrite,
+                           CategoryLang.link_rewrite\
+                                   .alias('cat_link_rewrite'))\
+                   .join(ProductLang)\
                    .join(CategoryLang, on=(CategoryLang.id_category ==
                                     Product.id_category_default))\
-                   .where((ProductLang.id_lang == LANG_ID) &
-                          (ProductLang.id_shop ==
-                           SHOP_ID) & (Stock.id_shop == SHOP_ID) &
-                           (Stock.id_product_attribute == 0) &
-                           (CategoryLang.id_lang == LANG_ID))\
-                   .group_by(Product.id_product).dicts():
-        el = Element("PRODUCT")
-        product_id = product['id_product']
-        i = SubElement(el, "PRODUCT_ID")
-        i.text = str("{}-0".format(product_id))
-        i = SubElement(el, "TITLE")
-        i.text = product['name']
-        i = SubElement(el, "DESCRIPTION")
-        i.text = product['description']
-        i = SubElement(el, "URL")
-        #i.text = PRODUCT_URL_TEMPLATE.format(id_product = product_id)
-        i.text = product_url(product)
-        i = SubElement(el, "IMAGE")
-        i.text = img_url(product['image'], product['link_rewrite'])
-        i = SubElement(el, "CATEGORYTEXT")
-        i.text = cat_names.get(product.get('id_category_default', 'None'), 'None')
-        stock = product['stock']
-        #stock = 1 #HACK, FIXME
-        active = product['active']
-        if not active:
-            stock = 0
-        if product['visibility'] == 'none':
-            stock = 0
-        if product['show_price'] <=0:
-            stock = 0
-        price, price_before = specific_price(product, dt_now, specific_prices,
-                                             taxes, rules, prod_cat, cat_prod)
-        wsp = product['wholesale_price']
-        i = SubElement(el, "STOCK")
-        i.text = str(stock)
-        i = SubElement(el, "PRICE")
-        i.text = str(price)
-        if price != price_before:
-            i = SubElement(el, "PRICE_BEFORE_DISCOUNT")
-            i.text = str(price_before)
-        if PRICE_BUY and wsp:
-            i = SubElement(el, "PRICE_BUY")
-            i.text = str(wsp)
-
-        par = SubElement(el, "PARAMETERS")
-        parameter(par, "width", product['width'])
-        parameter(par, "height", product['height'])
-        parameter(par, "depth", product['depth'])
-        parameter(par, "weight", product['weight'])
-
-        variants = ProductAttribute.select(ProductAttribute,
-                    ProductAttributeCombination).join(
-                            ProductAttributeCombination, on = (
-                            ProductAttribute.id_product_attribute ==
-                            ProductAttributeCombination.id_product_attribute))\
-                            .where(ProductAttribute.id_product
-                            == product_id)\
-                            .order_by(ProductAttributeCombination.id_product_attribute)
-        #print(variants.sql())
-        variants = variants.dicts()
-        variants = list(variants)
-        default_ixs = [ix for ix, v in enumerate(variants) if v.get('default_on')]
-        if default_ixs:
-            #move default variant to the first place
-            default_ix = default_ixs[0]
-            (variants[0], variants[default_ix]) = (variants[default_ix],
-                    variants[0])
+                   .where((ProductLang.id_lang == ctx.lang_id) &
+                          (ProductLang.id_shop == ctx.shop_id) &
+                          (CategoryLang.id_lang == ctx.lang_id))\
+                   .group_by(Product.id_product)\
+                   .order_by(Product.id_product)
+    if cond is not None:
+        query = query.where(cond)
+    return stream(query, Product.id_product)
+
+
+def product_record(Element, ctx, lookups, product, variants, prices):
+    """
+        PRODUCT element of target ctx
+        product - dict of Product row, texts, stock and variant_stock
+            (stock by id_product_attribute)
+        variants - (id_product_attribute, rows) groups, default first
+        prices - (price, price before discount) of product and variants,
+            see add_prices
+    """
+    prices = iter(prices)
+    attr_name, attr_val = lookups['attr_name'], lookups['attr_val']
+    el = Element("PRODUCT")
+    product_id = product['id_product']
+    i = SubElement(el, "PRODUCT_ID")
+    i.text = str("{}-0".format(product_id))
+    i = SubElement(el, "TITLE")
+    i.text = product['name']
+    i = SubElement(el, "DESCRIPTION")
+    i.text = product['description']
+    i = SubElement(el, "URL")
+    #i.text = PRODUCT_URL_TEMPLATE.format(id_product = product_id)
+    i.text, url_prefix = product_urls(ctx, product)
+    i = SubElement(el, "IMAGE")
+    i.text = img_url(product['image'], product['link_rewrite'])
+    i = SubElement(el, "CATEGORYTEXT")
+    i.text = cat_names[ctx].get(product.get('id_category_default', 'None'),
+                                'None')
+    #stock = 1 #HACK, FIXME
+    available = product['active'] and product['visibility'] != 'none' and \
+            product['show_price'] > 0
+    stock = product['stock'] if available else 0
+    price, price_before = next(prices)
+    wsp = product['wholesale_price']
+    i = SubElement(el, "STOCK")
+    i.text = str(stock)
+    i = SubElement(el, "PRICE")
+    i.text = str(price)
+    if price != price_before:
+        i = SubElement(el, "PRICE_BEFORE_DISCOUNT")
+        i.text = str(price_before)
+    if PRICE_BUY and wsp:
+        i = SubElement(el, "PRICE_BUY")
+        i.text = str(wsp)
+
+    par = SubElement(el, "PARAMETERS")
+    parameter(par, "width", product['width'])
+    parameter(par, "height", product['height'])
+    parameter(par, "depth", product['depth'])
+    parameter(par, "weight", product['weight'])
+
+    for id_product_attr, group in variants:
+        variant_id = "{}-{}".format(product_id,
+#                ":".join(sorted([str(it['id_attribute']) for it in group])))
+                 id_product_attr)
+        v = SubElement(el, "VARIANT")
+        i = SubElement(v, "PRODUCT_ID")
+        i.text = variant_id
+        i = SubElement(v, "URL")
+        if url_prefix is None:
+            i.text = product_url(ctx, product, variant_id)
         else:
-            default_ix = 0
-        #variants = list(variants)
-        #print(variants)
-        for id_product_attr, g in itertools.groupby(variants, key =
-                operator.itemgetter('id_product_attribute')):
-            group = list(g)
-            variant_id = "{}-{}".format(product_id,
-#                    ":".join(sorted([str(it['id_attribute']) for it in group])))
-                     id_product_attr)
-            v = SubElement(el, "VARIANT")
-            i = SubElement(v, "PRODUCT_ID")
-            i.text = variant_id
-            i = SubElement(v, "URL")
-            i.text = product_url(product, variant_id)
-            add_price = group[0].get('price')
-            if add_price:
-                i = SubElement(v, "PRICE")
-                price, price_before = specific_price(product, dt_now, specific_prices,
-                                             taxes, rules, prod_cat, cat_prod,
-                                             add_price = add_price)
-                i.text = str(price)
-                i = SubElement(v, "PRICE_BEFORE_DISCOUNT")
-                i.text = str(price_before)
-            parameters = [(attr_name[it['id_attribute']],
-                    attr_val[it['id_attribute']]) for it in group]
-            if parameters:
-                par = SubElement(v, "PARAMETERS")
-                for pn, pv in parameters:
-                    parameter(par, pn, pv)
-        f.write(el)
-
-
-with Feed('order', os.path.join(OUTPUT_DIRECTORY, 'orders.xml'), 'ORDERS') as f:
-    for order in Order.select() \
+            i.text = url_prefix + url_file(product, variant_id)
+        variant_stock = product['variant_stock'].get(id_product_attr)
+        if variant_stock is not None:
+            i = SubElement(v, "STOCK")
+            i.text = str(variant_stock if available else 0)
+        add_price = group[0].get('price')
+        if add_price:
+            i = SubElement(v, "PRICE")
+            price, price_before = next(prices)
+            i.text = str(price)
+            i = SubElement(v, "PRICE_BEFORE_DISCOUNT")
+            i.text = str(price_before)
+        parameters = [(attr_name[it['id_attribute']],
+                attr_val[it['id_attribute']]) for it in group]
+        if parameters:
+            par = SubElement(v, "PARAMETERS")
+            for pn, pv in parameters:
+                parameter(par, pn, pv)
+    return el
+
+
+def record_salt():
+    """ digest of code and configuration product records depend on """
+    sources = []
+    for module in (sys.modules[__name__], xml_writer, pricing):
+        with open(module.__file__, 'rb') as f:
+            sources.append(hashlib.sha1(f.read()).hexdigest())
+    return delta.digest([sources, PRODUCT_URL_BASE, IMAGE_URL_BASE,
+                         IMAGE_URL_TYPE, PRICE_BUY])
+
+
+def product_digest(salt, ctx, lookups, product, variants, tax, matches):
+    """ digest of all data PRODUCT element of ctx is built from """
+    attr_name, attr_val = lookups['attr_name'], lookups['attr_val']
+    return delta.digest([salt, ctx.lang, product, variants, tax, matches,
+            cat_names[ctx].get(product.get('id_category_default', 'None'),
+                               'None'),
+            [[(attr_name[it['id_attribute']], attr_val[it['id_attribute']])
+              for it in group] for id_product_attr, group in variants]])
+
+
+def product_records(targets, lookups, cond = None, cache = None,
+                    checkpoint = None):
+    """
+        PRODUCT elements of every target ordered by id_product, yields
+        list of elements by target, None if product has no texts or stock
+        in target, products without any element are skipped.
+        Products, images and variants are read once, texts are read per
+        target.
+        lookups - list of load_product_lookups by target
+        cond (peewee expression) limits exported products
+        cache - RecordCache, products with unchanged data are yielded as
+            serialized bytes from cache, see RECORD_CACHE in config.py
+        checkpoint - Checkpoint, its key is set to id_product of yielded
+            product
+    """
+    Element = record_factory('product')
+    if cache is not None:
+        salt = record_salt()
+        cache_targets = [json.dumps(key) for key in target_keys(targets)]
+    specific_prices = [SpecificPriceIndex(lk['specific_prices'], ctx,
+                                          lk['rules'], lk['rule_members'])
+                       for ctx, lk in zip(targets, lookups)]
+    product_variants = GroupCursor(load_variants(cond),
+                                   operator.itemgetter('id_product'))
+    texts = [GroupCursor(load_product_texts(ctx, cond),
+                         operator.itemgetter('id_product'))
+             for ctx in targets]
+    query = Product.select(Product,
+                           peewee.fn.min(Image.id_image).alias('image'))\
+                   .join(Image, on=(Product.id_product == Image.id_product),
+                         attr='image')\
+                   .group_by(Product.id_product)\
+                   .order_by(Product.id_product)
+    if cond is not None:
+        query = query.where(cond)
+    rows = stream(query, Product.id_product)
+    while True:
+        #prices of chunk of products are computed at once
+        chunk = list(itertools.islice(rows, PRICE_BATCH))
+        if not chunk:
+            return
+        batch = pricing.PriceBatch()
+        products = []
+        for row in chunk:
+            product_id = row['id_product']
+            variants = product_variants.get(product_id)
+            default_ixs = [ix for ix, v in enumerate(variants)
+                           if v.get('default_on')]
+            if default_ixs:
+                #move default variant to the first place
+                default_ix = default_ixs[0]
+                (variants[0], variants[default_ix]) = (variants[default_ix],
+                        variants[0])
+            else:
+                default_ix = 0
+            variants = [(id_product_attr, list(g)) for id_product_attr, g in
+                        itertools.groupby(variants, key =
+                            operator.itemgetter('id_product_attribute'))]
+            target_products = []
+            for i, (ctx, lk, prices, target_texts) in enumerate(zip(targets,
+                    lookups, specific_prices, texts)):
+                text = target_texts.get(product_id)
+                stock = lk['stock'].get(product_id)
+                if not text or stock is None:
+                    target_products.append(None)
+                    continue
+                product = dict(row)
+                product.update(text[0])
+                product['stock'] = stock
+                product['variant_stock'] = lk['variant_stock'].get(product_id,
+                                                                   {})
+                with metrics.stage('price'):
+                    tax, matches = match_prices(product, variants, prices,
+                                                lk['taxes'])
+                digest = None
+                if cache is not None:
+                    with metrics.stage('cache'):
+                        digest = product_digest(salt, ctx, lk, product,
+                                                variants, tax, matches)
+                        xml = cache.get(cache_targets[i], product_id, digest)
+                    if xml is not None:
+                        target_products.append(xml)
+                        continue
+                with metrics.stage('price'):
+                    indexes = add_prices(batch, product, variants, tax,
+                                         matches)
+                target_products.append((product, indexes, digest))
+            if any(target_products):
+                products.append((product_id, variants, target_products))
+        with metrics.stage('price'):
+            results = batch.compute(PRICE_BACKEND)
+        for product_id, variants, target_products in products:
+            els = []
+            for i, (ctx, lk, target_product) in enumerate(zip(targets,
+                    lookups, target_products)):
+                if type(target_product) is not tuple:
+                    #None or cached bytes
+                    els.append(target_product)
+                    continue
+                product, indexes, digest = target_product
+                el = product_record(Element, ctx, lk, product, variants,
+                                    [results[ix] for ix in indexes])
+                if cache is not None:
+                    el = serialize(el)
+                    cache.put(cache_targets[i], product['id_product'],
+                              digest, el)
+                els.append(el)
+            if checkpoint is not None:
+                checkpoint.key = product_id
+            yield els
+
+
+def order_feed(cond = None, checkpoint = None):
+    """
+        ORDER elements ordered by id_order
+        cond (peewee expression) limits exported orders
+        checkpoint - Checkpoint, its key is set to id_order of yielded order
+    """
+    Element = record_factory('order')
+    order_items = GroupCursor(load_order_items(cond),
+                              operator.itemgetter('id_order'))
+    query = Order.select(Order, Address.postcode, Customer.email) \
                  .join(Address, on=(Order.id_address_delivery ==
-                                    Address.id_address)):
+                                    Address.id_address)) \
+                 .switch(Order) \
+                 .join(Customer, peewee.JOIN.LEFT_OUTER,
+                       on=(Order.id_customer == Customer.id_customer)) \
+                 .order_by(Order.id_order)
+    if cond is not None:
+        query = query.where(cond)
+    for order in stream(query, Order.id_order):
         el = Element("ORDER")
         i = SubElement(el, "ORDER_ID")
-        i.text = str(order.id_order)
+        i.text = str(order['id_order'])
         i = SubElement(el, "CUSTOMER_ID")
-        #i.text = str(order.id_customer)
-        i.text = b64(str(customer_email.get(order.id_customer, "")))
+        #i.text = str(order['id_customer'])
+        i.text = b64(str(order['email'] or ""))
         i = SubElement(el, "CREATED_ON")
-        i.text = dt_iso(order.date_add)
+        i.text = dt_iso(order['date_add'])
         i = SubElement(el, "FINISHED_ON")
-        i.text = dt_iso(order.delivery_date)
+        i.text = dt_iso(order['delivery_date'])
         i = SubElement(el, "STATUS")
-        i.text = order_state(order.current_state)
+        i.text = order_state(order['current_state'])
         i = SubElement(el, "ZIP_CODE")
-        i.text = order.id_address_delivery.postcode
+        i.text = order['postcode']
         it = SubElement(el, "ITEMS")
-        for item in order.items:
+        for item in order_items.get(order['id_order']):
             i2 = SubElement(it, "ITEM")
             i = SubElement(i2, "PRODUCT_ID")
-            i.text = "{}-{}".format(item.product_id,
-                item.product_attribute_id)
+            i.text = "{}-{}".format(item['product_id'],
+                item['product_attribute_id'])
             i = SubElement(i2, "PRICE")
-            i.text = str(item.total_price_tax_incl)
+            i.text = str(item['total_price_tax_incl'])
             i = SubElement(i2, "AMOUNT")
-            i.text = str(int(item.product_quantity))
+            i.text = str(int(item['product_quantity']))
+
+        if checkpoint is not None:
+            checkpoint.key = order['id_order']
+        yield el
+
+
+def export(targets, name, fname, tag, records, checkpoint = None):
+    """
+        write feed fname into output directory of every target
+        records yield list of elements by target, None skips target
+        checkpoint - Checkpoint saved every CHUNK_SIZE records, records
+            continue after its key if it has saved offsets
+    """
+    offsets = [None] * len(targets)
+    if checkpoint is not None and checkpoint.offsets is not None:
+        offsets = checkpoint.offsets
+    with contextlib.ExitStack() as stack:
+        feeds = [stack.enter_context(Feed(name,
+                    os.path.join(ctx.output_directory, fname), tag,
+                    COMPRESS, COMPRESS_LEVEL, offset,
+                    keep = checkpoint is not None))
+                 for ctx, offset in zip(targets, offsets)]
+        for n, els in enumerate(metrics.records(records), 1):
+            with metrics.stage('write'):
+                for f, el in zip(feeds, els):
+                    if el is not None:
+                        f.write(el)
+                if checkpoint is not None and n % CHUNK_SIZE == 0:
+                    checkpoint.save([f.tell() for f in feeds])
+    if checkpoint is not None:
+        checkpoint.clear()
+
+
+def feed_checkpoint(targets, fname):
+    """ Checkpoint of feed fname, None if disabled """
+    if not CHECKPOINT:
+        return None
+    checkpoint = Checkpoint(os.path.join(targets[0].output_directory,
+                                         fname + '.checkpoint'),
+                            [os.path.join(ctx.output_directory, fname)
+                             for ctx in targets], CHECKPOINT_MAX_AGE)
+    if checkpoint.offsets is not None:
+        print("{} continues after key {}".format(fname, checkpoint.key),
+              file = sys.stderr)
+    return checkpoint
+
 
-        f.write(el)
+def resume_cond(key, checkpoint):
+    """ condition of records not written before checkpoint, key - field """
+    if checkpoint is None or checkpoint.offsets is None:
+        return None
+    return key > checkpoint.key
+
+
+def export_delta(targets, name, fname, tag, record_tag, key_tag, records,
+                 removed = None):
+    """
+        merge changed records into feed files of previous run, records
+        have to contain all records with key of every changed record
+        removed - set of removed keys by target
+    """
+    changed = [collections.OrderedDict() for ctx in targets]
+    for els in metrics.records(records):
+        for target_changed, el in zip(changed, els):
+            if el is not None:
+                target_changed.setdefault(el.findtext(key_tag), [])\
+                        .append(el)
+    if removed is None:
+        removed = [()] * len(targets)
+    for ctx, target_changed, target_removed in zip(targets, changed,
+                                                   removed):
+        path = os.path.join(ctx.output_directory, fname)
+        with metrics.stage('write'), \
+                Feed(name, path, tag, COMPRESS, COMPRESS_LEVEL) as f:
+            delta.merge(path, f, record_tag, key_tag, target_changed,
+                        target_removed)
+
+
+def product_digests(lookups):
+    """
+        digest by id_product of product data not covered by
+        Product.date_upd: stock, variant stock and specific prices of
+        product in every target, price and attributes of its variants,
+        one digest per product keeps delta state small, every product of
+        Product table has digest
+    """
+    data = {pid: [] for pid, in Product.select(Product.id_product).tuples()}
+    for i, lk in enumerate(lookups):
+        for pid, quantity in sorted(lk['stock'].items()):
+            if pid in data:
+                data[pid].append(['stock', i, quantity])
+        for pid, stock in sorted(lk['variant_stock'].items()):
+            if pid in data:
+                data[pid].append(['variant_stock', i, sorted(stock.items())])
+        for price in lk['specific_prices']:
+            if price.get('id_product') in data:
+                data[price['id_product']].append(['price', i, price])
+    #combinations are edited without change of Product.date_upd
+    for pid, paid, price, attr in ProductAttribute.select(
+                ProductAttribute.id_product,
+                ProductAttribute.id_product_attribute, ProductAttribute.price,
+                ProductAttributeCombination.id_attribute)\
+            .join(ProductAttributeCombination, on = (
+                ProductAttribute.id_product_attribute ==
+                ProductAttributeCombination.id_product_attribute))\
+            .order_by(ProductAttribute.id_product,
+                      ProductAttribute.id_product_attribute,
+                      ProductAttributeCombination.id_attribute).tuples():
+        if pid in data:
+            data[pid].append(['variant', paid, price, attr])
+    #64 bits are enough to detect change of one product
+    return {str(pid): delta.digest(v)[:16] for pid, v in data.items()}
+
+
+def target_keys(targets):
+    """ targets as stored in delta state """
+    return [[ctx.shop_id, ctx.lang, ctx.output_directory] for ctx in targets]
+
+
+def full_export(targets, last, fname, watermark, dt_now):
+    """ feed is exported completely in delta mode """
+    if watermark is None or not last:
+        return True
+    if last.get('targets') != target_keys(targets):
+        return True
+    for ctx in targets:
+        if not os.path.exists(os.path.join(ctx.output_directory, fname)):
+            return True
+    full = datetime.datetime.fromisoformat(last['full'])
+    return dt_now - full > datetime.timedelta(hours = DELTA_FULL_AFTER)
+
+
+def feed_state(targets, last, full, dt_now, **watermarks):
+    """ delta state of feed after export """
+    state = dict(watermarks)
+    state['full'] = dt_now.isoformat() if full else last['full']
+    state['targets'] = target_keys(targets)
+    return state
+
+
+@metrics.feed('customers')
+def export_customers(targets, state, dt_now):
+    """
+        customers feed, returns delta state
+        delta: Customer.date_upd, CUSTOMER_ID is not unique (guest and
+            registered account can share email), all customers with email
+            of changed customer are exported
+    """
+    if not DELTA:
+        checkpoint = feed_checkpoint(targets, 'customers.xml')
+        export(targets, 'customer', 'customers.xml', 'CUSTOMERS',
+               customer_records(targets,
+                                resume_cond(Customer.id_customer, checkpoint),
+                                checkpoint), checkpoint)
+        return None
+    last = state.get('customers')
+    date_upd = Customer.select(peewee.fn.max(Customer.date_upd)).scalar()
+    full = full_export(targets, last, 'customers.xml', date_upd, dt_now)
+    if full:
+        export(targets, 'customer', 'customers.xml', 'CUSTOMERS',
+               customer_records(targets))
+    else:
+        export_delta(targets, 'customer', 'customers.xml', 'CUSTOMERS',
+                     'CUSTOMER', 'CUSTOMER_ID',
+                     customer_records(targets, Customer.email.in_(
+                         Customer.select(Customer.email).where(
+                             Customer.date_upd >= last['date_upd']))))
+    return feed_state(targets, last, full, dt_now, date_upd = date_upd)
+
+
+def product_cache(prune = True):
+    """
+        RecordCache of products, see RECORD_CACHE in config.py
+        prune - drop cached products not exported by this run
+    """
+    if RECORD_CACHE is None:
+        return contextlib.nullcontext()
+    return RecordCache(RECORD_CACHE, prune)
+
+
+#targets and lookups of sharded products export, inherited by forked
+#worker processes
+shard_data = None
+
+def product_shards(n):
+    """ (first id_product, next shard first id_product or None) ranges """
+    ids = [row[0] for row in Product.select(Product.id_product)
+                                    .order_by(Product.id_product).tuples()]
+    starts = [ids[len(ids) * i // n] for i in range(n) if ids]
+    starts = sorted(set(starts))
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def render_shard(shard):
+    """
+        write products of shard (index, first id, next first id) into
+        products.xml.shard-index of every target in worker process,
+        returns number of records
+    """
+    index, first, end = shard
+    targets, lookups = shard_data
+    cond = Product.id_product >= first
+    if end is not None:
+        cond = cond & (Product.id_product < end)
+    rows = 0
+    try:
+        with contextlib.ExitStack() as stack:
+            feeds = [stack.enter_context(Feed('product',
+                        os.path.join(ctx.output_directory,
+                                     'products.xml.shard-{}'.format(index)),
+                        'PRODUCTS')) for ctx in targets]
+            for els in product_records(targets, lookups, cond):
+                rows += 1
+                for f, el in zip(feeds, els):
+                    if el is not None:
+                        f.write(el)
+    finally:
+        db.close()
+    return rows
+
+
+def export_sharded(targets, lookups):
+    """
+        products feed rendered by PRODUCT_PROCESSES forked processes, every
+        process renders id_product range shards, shards are joined in order
+        processes are forked, so no other thread may run, see export_all
+    """
+    global shard_data
+    if threading.active_count() > 1:
+        raise RuntimeError("products feed can't fork PRODUCT_PROCESSES "
+                           "while other threads are running")
+    shards = [(i, first, end) for i, (first, end) in
+              enumerate(product_shards(PRODUCT_PROCESSES * 4))]
+    shard_data = (targets, lookups)
+    #children open their own connections
+    db.close()
+    mp = multiprocessing.get_context('fork')
+    try:
+        with mp.Pool(PRODUCT_PROCESSES) as pool, \
+                contextlib.ExitStack() as stack:
+            feeds = [stack.enter_context(Feed('product',
+                        os.path.join(ctx.output_directory, 'products.xml'),
+                        'PRODUCTS', COMPRESS, COMPRESS_LEVEL))
+                     for ctx in targets]
+            results = pool.imap(render_shard, shards)
+            for index, first, end in shards:
+                with metrics.stage('build'):
+                    metrics.add_rows(next(results))
+                with metrics.stage('write'):
+                    for ctx, f in zip(targets, feeds):
+                        path = os.path.join(ctx.output_directory,
+                                            'products.xml.shard-{}'
+                                            .format(index))
+                        f.append_feed(path)
+                        os.remove(path)
+    finally:
+        shard_data = None
+        for ctx in targets:
+            for index, first, end in shards:
+                path = os.path.join(ctx.output_directory,
+                                    'products.xml.shard-{}'.format(index))
+                for tmp in (path, path + '.tmp'):
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+
+
+def export_all_products(targets, lookups, checkpoint = None):
+    """
+        full export of products feed, sharded if PRODUCT_PROCESSES > 1,
+        otherwise using record cache and checkpoint
+    """
+    if PRODUCT_PROCESSES > 1:
+        export_sharded(targets, lookups)
+        return
+    cond = resume_cond(Product.id_product, checkpoint)
+    with product_cache(cond is None) as cache:
+        export(targets, 'product', 'products.xml', 'PRODUCTS',
+               product_records(targets, lookups, cond, cache, checkpoint),
+               checkpoint)
+
+
+@metrics.feed('products')
+def export_products(targets, state, dt_now):
+    """
+        products feed, returns delta state
+        delta: Product.date_upd, digest of stock of product and its
+            variants, specific prices of product and prices and attributes
+            of variants, see product_digests,
+            change of shared data (taxes, rules and their products,
+            categories, attributes)
+            exports all products
+    """
+    lookups = load_product_lookups(targets, dt_now)
+    if not DELTA:
+        export_all_products(targets, lookups,
+                            feed_checkpoint(targets, 'products.xml'))
+        return None
+    last = state.get('products')
+    with metrics.stage('delta'):
+        date_upd = Product.select(peewee.fn.max(Product.date_upd)).scalar()
+        digests = product_digests(lookups)
+        #specific prices of all products
+        prices = [[i, price] for i, lk in enumerate(lookups)
+                  for price in lk['specific_prices']
+                  if not price.get('id_product')]
+        #products of catalog price rules, the same for all targets
+        members = sorted([typ, value, sorted(ids)] for (typ, value), ids in
+                         lookups[0]['rule_members'].items())
+        shared = delta.digest([[lk['taxes'], lk['rules'], lk['attr_name'],
+                                lk['attr_val'], cat_names[ctx]]
+                               for ctx, lk in zip(targets, lookups)] +
+                              [prices, members])
+    full = full_export(targets, last, 'products.xml', date_upd, dt_now) or \
+            last.get('shared') != shared or 'digests' not in last
+    if full:
+        export_all_products(targets, lookups)
+    else:
+        last_digests = last['digests']
+        changed = {k for k, v in digests.items() if last_digests.get(k) != v}
+        deleted = set(last_digests) - set(digests)
+        #product without stock row in target is not exported there
+        removed = [{'{}-0'.format(k) for k in changed
+                    if int(k) not in lk['stock']} |
+                   {'{}-0'.format(k) for k in deleted} for lk in lookups]
+        cond = Product.date_upd >= last['date_upd']
+        if changed:
+            cond = cond | Product.id_product.in_(sorted(int(k) for k in
+                                                         changed))
+        export_delta(targets, 'product', 'products.xml', 'PRODUCTS',
+                     'PRODUCT', 'PRODUCT_ID',
+                     product_records(targets, lookups, cond), removed)
+    return feed_state(targets, last, full, dt_now, date_upd = date_upd,
+                      digests = digests, shared = shared)
+
+
+ORDER_MANIFEST = 'orders-manifest.json'
+
+def month_start(dt):
+    return datetime.datetime(dt.year, dt.month, 1)
+
+
+def next_month(month):
+    return datetime.datetime(month.year + month.month // 12,
+                             month.month % 12 + 1, 1)
+
+
+def order_months():
+    """ months with orders, every month is found by index seek on date_add """
+    months = []
+    while True:
+        query = Order.select(peewee.fn.min(Order.date_add))
+        if months:
+            query = query.where(Order.date_add >= next_month(months[-1]))
+        first = query.scalar()
+        if first is None:
+            return months
+        months.append(month_start(first))
+
+
+def file_digest(path):
+    """ sha1 of file content """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(1 << 20), b''):
+            h.update(data)
+    return h.hexdigest()
+
+
+def load_manifest(ctx):
+    """ manifest of orders feed in output directory of ctx """
+    path = os.path.join(ctx.output_directory, ORDER_MANIFEST)
+    if not os.path.exists(path):
+        return {'partitions': []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(ctx, manifest):
+    path = os.path.join(ctx.output_directory, ORDER_MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(path + '.tmp', path)
+
+
+def export_order_partitions(targets, dt_now):
+    """
+        orders feed partitioned by month of date_add, see ORDER_PARTITIONS
+        in config.py, frozen partitions (older than window) are kept,
+        months without orders have no partition, orders.xml is joined
+        again only if a partition changed
+    """
+    window = month_start(dt_now)
+    for i in range(ORDER_PARTITIONS - 1):
+        window = month_start(window - datetime.timedelta(days = 1))
+    manifests = [load_manifest(ctx) for ctx in targets]
+    kept_parts = [{part['file']: part for part in manifest['partitions']}
+                  for manifest in manifests]
+    partitions = []
+    for month in order_months():
+        fname = 'orders-{:%Y-%m}.xml'.format(month)
+        frozen = month < window
+        kept = [parts.get(fname) for parts in kept_parts]
+        if not frozen or not all(part and part['frozen'] and
+                'digest' in part and
+                os.path.exists(os.path.join(ctx.output_directory, fname))
+                for ctx, part in zip(targets, kept)):
+            export(targets, 'order', fname, 'ORDERS',
+                   shared(order_feed((Order.date_add >= month) &
+                                     (Order.date_add < next_month(month))),
+                          targets))
+            kept = [{'exported': dt_now.isoformat(),
+                     'digest': file_digest(os.path.join(
+                         ctx.output_directory, fname))} for ctx in targets]
+        partitions.append((fname, month, frozen, kept))
+    files = {fname for fname, month, frozen, kept in partitions}
+    with metrics.stage('write'):
+        for i, ctx in enumerate(targets):
+            manifest = {'compress': list(COMPRESS),
+                        'partitions': [{'file': fname,
+                                        'month': '{:%Y-%m}'.format(month),
+                                        'frozen': frozen,
+                                        'size': os.path.getsize(os.path.join(
+                                            ctx.output_directory, fname)),
+                                        'digest': kept[i]['digest'],
+                                        'exported': kept[i]['exported']}
+                                       for fname, month, frozen, kept in
+                                       partitions]}
+            #partitions of months whose orders are gone
+            for fname in kept_parts[i]:
+                path = os.path.join(ctx.output_directory, fname)
+                if fname not in files and os.path.exists(path):
+                    os.remove(path)
+            path = os.path.join(ctx.output_directory, 'orders.xml')
+            last = [(part['file'], part.get('digest'))
+                    for part in manifests[i]['partitions']]
+            if not os.path.exists(path) or \
+                    manifests[i].get('compress') != manifest['compress'] or \
+                    last != [(part['file'], part['digest'])
+                             for part in manifest['partitions']]:
+                with Feed('order', path, 'ORDERS', COMPRESS,
+                          COMPRESS_LEVEL) as f:
+                    for fname, month, frozen, kept in partitions:
+                        f.append_feed(os.path.join(ctx.output_directory,
+                                                   fname))
+            save_manifest(ctx, manifest)
+
+
+@metrics.feed('orders')
+def export_orders(targets, state, dt_now):
+    """
+        orders feed, the same for every target, returns delta state
+        delta: new id_order and new OrderHistory (state change) records
+        partitioned feed has no delta state
+    """
+    if ORDER_PARTITIONS:
+        export_order_partitions(targets, dt_now)
+        return None
+    if not DELTA:
+        checkpoint = feed_checkpoint(targets, 'orders.xml')
+        export(targets, 'order', 'orders.xml', 'ORDERS',
+               shared(order_feed(resume_cond(Order.id_order, checkpoint),
+                                 checkpoint), targets), checkpoint)
+        return None
+    last = state.get('orders')
+    id_order = Order.select(peewee.fn.max(Order.id_order)).scalar()
+    id_history = OrderHistory.select(
+            peewee.fn.max(OrderHistory.id_order_history)).scalar() or 0
+    full = full_export(targets, last, 'orders.xml', id_order, dt_now)
+    if full:
+        export(targets, 'order', 'orders.xml', 'ORDERS',
+               shared(order_feed(), targets))
+    else:
+        cond = (Order.id_order > last['id_order']) | \
+                Order.id_order.in_(OrderHistory.select(OrderHistory.id_order)
+                    .where(OrderHistory.id_order_history >
+                           last['id_history']))
+        export_delta(targets, 'order', 'orders.xml', 'ORDERS', 'ORDER',
+                     'ORDER_ID', shared(order_feed(cond), targets))
+    return feed_state(targets, last, full, dt_now, id_order = id_order,
+                      id_history = id_history)
+
+
+def worker(fn, *args):
+    """ run export task in worker thread, thread has its own connection """
+    try:
+        return fn(*args)
+    finally:
+        db.close()
+
+
+#tables read by feeds, probed for changes in daemon mode
+FEED_TABLES = collections.OrderedDict([
+    ('categories', [Category, CategoryLang]),
+    ('customers', [Customer, Address, GenderLang]),
+    ('products', [Product, ProductLang, ProductAttribute,
+                  ProductAttributeCombination, Attribute, AttributeLang,
+                  AttributeGroupLang, Stock, SpecificPrice, SpecificPriceRule,
+                  SpecificPriceConditionGroup, SpecificPriceCondition,
+                  Category, CategoryLang, ProductCategory, ProductSupplier,
+                  FeatureProduct, Tax, TaxRule, Image]),
+    ('orders', [Order, OrderDetail, OrderHistory, Address, Customer]),
+])
+
+#tables probed by row count and sums of columns changed in place without
+#date_upd, small tables always, big ones with DAEMON_PROBE_SUMS only
+PROBE_SUMS = {
+    SpecificPriceRule: [SpecificPriceRule.price, SpecificPriceRule.reduction],
+    SpecificPriceConditionGroup: [],
+    SpecificPriceCondition: [],
+    Tax: [Tax.rate],
+    TaxRule: [],
+    GenderLang: [],
+}
+PROBE_BIG_SUMS = {
+    #weighted sum changes when stock moves between variants
+    Stock: [Stock.quantity, Stock.quantity * Stock.id_product_attribute],
+    ProductAttribute: [ProductAttribute.price],
+    SpecificPrice: [SpecificPrice.price, SpecificPrice.reduction],
+}
+
+
+def probe_table(model, dt_now):
+    """
+        cheap fingerprint of table read from indexes: max primary key,
+        max date_upd and the last date_from/date_to already passed (price
+        becomes active or expires without table change), see
+        RECOMMENDED_INDEXES, tables of PROBE_SUMS add row count and sums
+        of their columns
+    """
+    fields = model._meta.fields
+    columns = []
+    if model._meta.primary_key:
+        columns.append(peewee.fn.MAX(model._meta.primary_key))
+    if 'date_upd' in fields:
+        columns.append(peewee.fn.MAX(fields['date_upd']))
+    sums = PROBE_SUMS.get(model)
+    if sums is None and DAEMON_PROBE_SUMS:
+        sums = PROBE_BIG_SUMS.get(model)
+    if sums is not None:
+        columns.append(peewee.fn.COUNT(peewee.SQL('*')))
+        columns.extend(peewee.fn.SUM(field) for field in sums)
+    fingerprint = []
+    if columns:
+        fingerprint.extend(model.select(*columns).tuples().get())
+    for name in ('date_from', 'date_to'):
+        if name in fields:
+            fingerprint.append(model.select(peewee.fn.MAX(fields[name]))
+                                    .where(fields[name] <= dt_now).scalar())
+    return fingerprint
+
+
+def table_update_times():
+    """
+        UPDATE_TIME of tables from information_schema, catches changes in
+        place and deletes in tables not covered by probe_table. Empty if
+        the server doesn't track it.
+    """
+    try:
+        cursor = db.execute_sql("SELECT TABLE_NAME, UPDATE_TIME FROM "
+                                "information_schema.TABLES WHERE "
+                                "TABLE_SCHEMA = %s", (db.database,))
+    except peewee.DatabaseError:
+        return {}
+    return dict(cursor.fetchall())
+
+
+def probe(dt_now):
+    """ fingerprint of tables of every feed """
+    update_times = table_update_times()
+    tables = {}
+    fingerprints = {}
+    for feed, models in FEED_TABLES.items():
+        for model in models:
+            if model not in tables:
+                tables[model] = probe_table(model, dt_now) + \
+                        [update_times.get(model._meta.table_name)]
+        fingerprints[feed] = [tables[model] for model in models]
+    return fingerprints
+
+
+def changed_feeds(targets, fingerprints, last, dt_now):
+    """
+        feeds with changed fingerprint, missing feed file or exported more
+        than DAEMON_FORCE_AFTER hours ago
+        last - {feed: (fingerprint, export time)} of previous runs
+    """
+    changed = []
+    for feed, fingerprint in fingerprints.items():
+        if feed in last:
+            last_fingerprint, exported = last[feed]
+            if last_fingerprint == fingerprint and \
+                    dt_now - exported < datetime.timedelta(
+                        hours = DAEMON_FORCE_AFTER) and \
+                    all(os.path.exists(os.path.join(ctx.output_directory,
+                                                    feed + '.xml'))
+                        for ctx in targets):
+                continue
+        changed.append(feed)
+    return changed
+
+
+@contextlib.contextmanager
+def run_lock():
+    """ exclusive lock of RUN_LOCK_FILE, yields False if other run holds it """
+    with open(RUN_LOCK_FILE, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def run(last = None):
+    """
+        export feeds and write run report, see WORKERS, DELTA and
+        METRICS_REPORT in config.py
+        last - {feed: (fingerprint, export time)} of previous runs, feeds
+            with unchanged tables are skipped, None exports all feeds
+        returns updated last, None if other run holds RUN_LOCK_FILE
+    """
+    with run_lock() as locked:
+        if not locked:
+            return None
+        metrics.reset(METRICS_SLOW_QUERY)
+        #daemon picks up changes of prestashop configuration
+        clear_settings()
+        cat_names.clear()
+        success = False
+        try:
+            last = export_all(last)
+            success = True
+        finally:
+            metrics.save(metrics.report(success), METRICS_REPORT,
+                         METRICS_PROMETHEUS)
+    return last
+
+
+def daemon():
+    """ run export every DAEMON_INTERVAL seconds, failed run is retried """
+    last = {}
+    while True:
+        started = time.monotonic()
+        try:
+            result = run(last)
+            if result is None:
+                print("export is already running, skipping", file = sys.stderr)
+            else:
+                last = result
+        except Exception:
+            traceback.print_exc()
+        time.sleep(max(0, DAEMON_INTERVAL - (time.monotonic() - started)))
+
+
+def export_targets():
+    """ ShopContext of every target, see TARGETS in config.py """
+    if not TARGETS:
+        return [shop_context()]
+    return [shop_context(lang, shop_id, output_directory = directory)
+            for shop_id, lang, directory in TARGETS]
+
+
+def export_all(last = None):
+    """
+        categories are exported first, they refresh cat_names used by
+        products feed
+        last - see run(), returns updated last, {} if last is None
+    """
+    dt_now = datetime.datetime.now()
+    targets = export_targets()
+    feeds = list(FEED_TABLES)
+    if last is not None:
+        fingerprints = probe(dt_now)
+        feeds = changed_feeds(targets, fingerprints, last, dt_now)
+        last = dict(last)
+        last.update((feed, (fingerprints[feed], dt_now)) for feed in feeds)
+    for feed in FEED_TABLES:
+        if feed not in feeds:
+            metrics.skip(feed)
+    state = delta.load_state(DELTA_STATE_FILE) if DELTA else {}
+    if 'categories' in feeds:
+        with metrics.feed('categories'):
+            for ctx in targets:
+                export([ctx], 'category', 'categories.xml', 'CATEGORIES',
+                       shared(category_feed(ctx), [ctx]))
+    tasks = [(feed, fn) for feed, fn in (('customers', export_customers),
+                                         ('products', export_products),
+                                         ('orders', export_orders))
+             if feed in feeds]
+    results = {}
+    if WORKERS > 1 and PRODUCT_PROCESSES > 1:
+        #forked processes of products feed would inherit locks held by
+        #worker threads (database driver, logging), products go first
+        for feed, fn in tasks:
+            if feed == 'products':
+                results[feed] = fn(targets, state, dt_now)
+        tasks = [(feed, fn) for feed, fn in tasks if feed != 'products']
+    if WORKERS > 1:
+        with ThreadPoolExecutor(WORKERS) as pool:
+            futures = [(feed, pool.submit(worker, fn, targets, state,
+                                          dt_now)) for feed, fn in tasks]
+            for feed, future in futures:
+                results[feed] = future.result()
+    else:
+        for feed, fn in tasks:
+            results[feed] = fn(targets, state, dt_now)
+    if DELTA:
+        #skipped feeds keep state of their last export
+        delta.save_state(DELTA_STATE_FILE, {feed: results.get(feed,
+                                                              state.get(feed))
+                                            for feed in ('customers',
+                                                         'products',
+                                                         'orders')})
+    return {} if last is None else last
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+            formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--daemon', action = 'store_true',
+                        help = 'export periodically, see DAEMON_INTERVAL '
+                               'in config.py')
+    parser.add_argument('--check-indexes', action = 'store_true',
+                        help = 'print indexes recommended for export '
+                               'queries and exit')
+    args = parser.parse_args()
+    if args.check_indexes:
+        for statement in check_indexes():
+            print(statement)
+    elif args.daemon:
+        daemon()
+    elif run() is None:
+        sys.exit("export is already running, see RUN_LOCK_FILE in config.py")
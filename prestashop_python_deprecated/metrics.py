@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+
+"""
+    export instrumentation
+    (C) 2026 DiffSolutions s.r.o.
+    Licensed under CC BY-SA 4.0
+
+    * time of every feed is split into exclusive stages, nested stage
+      pauses the outer one (time of sql inside build is counted as sql),
+      stages are 'sql', 'lookups', 'delta', 'build', 'price', 'cache',
+      'write' and 'other' for the rest of feed time
+    * rows, queries and retried queries are counted per feed, slow
+      queries are logged
+    * run report is written as JSON and as prometheus textfile
+    * every feed is measured in one thread, threads don't share stats
+"""
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+local = threading.local()
+feeds = collections.OrderedDict()
+skipped = []
+slow_queries = []
+slow_query = 1.0
+started = time.time()
+
+def reset(slow = 1.0):
+    """ start new run, slow - time in seconds of query logged as slow """
+    global feeds, skipped, slow_queries, slow_query, started
+    feeds = collections.OrderedDict()
+    skipped = []
+    slow_queries = []
+    slow_query = slow
+    started = time.time()
+
+def peak_rss():
+    """ peak resident memory of process in bytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def push(stage):
+    stats = getattr(local, 'stats', None)
+    if stats is None:
+        return
+    now = time.perf_counter()
+    stages = stats['stages']
+    stages[local.stack[-1]] = stages.get(local.stack[-1], 0) + now - local.mark
+    local.stack.append(stage)
+    local.mark = now
+
+def pop():
+    stats = getattr(local, 'stats', None)
+    if stats is None:
+        return
+    now = time.perf_counter()
+    stages = stats['stages']
+    stages[local.stack[-1]] = stages.get(local.stack[-1], 0) + now - local.mark
+    local.stack.pop()
+    local.mark = now
+
+@contextlib.contextmanager
+def stage(name):
+    push(name)
+    try:
+        yield
+    finally:
+        pop()
+
+@contextlib.contextmanager
+def feed(name):
+    """ measure feed name in current thread, works as decorator too """
+    stats = {'rows': 0, 'queries': 0, 'slow_queries': 0, 'retries': 0,
+             'stages': {}}
+    feeds[name] = stats
+    local.stats = stats
+    local.name = name
+    local.stack = ['other']
+    t0 = local.mark = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        pop()
+        stats['seconds'] = time.perf_counter() - t0
+        stats['peak_rss'] = peak_rss()
+        local.stats = None
+
+def skip(name):
+    """ feed name was not exported in this run """
+    skipped.append(name)
+
+@contextlib.contextmanager
+def query(sql):
+    """ measure sql query executed in current thread """
+    stats = getattr(local, 'stats', None)
+    if stats is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    push('sql')
+    try:
+        yield
+    finally:
+        pop()
+        stats['queries'] += 1
+        seconds = time.perf_counter() - t0
+        if seconds >= slow_query:
+            stats['slow_queries'] += 1
+            slow_queries.append({'feed': local.name, 'seconds': seconds,
+                                 'sql': sql})
+
+def retried():
+    """ query of feed in current thread failed and is retried """
+    stats = getattr(local, 'stats', None)
+    if stats is not None:
+        stats['retries'] += 1
+
+def add_rows(count):
+    """ records of feed in current thread built by other process """
+    stats = getattr(local, 'stats', None)
+    if stats is not None:
+        stats['rows'] += count
+
+def records(iterable):
+    """ iterate over feed records, measures their building as 'build' """
+    it = iter(iterable)
+    stats = getattr(local, 'stats', None)
+    while True:
+        push('build')
+        try:
+            el = next(it)
+        except StopIteration:
+            return
+        finally:
+            pop()
+        if stats is not None:
+            stats['rows'] += 1
+        yield el
+
+def report(success = True):
+    """ run report as JSON serializable dict """
+    return {
+        'started': started,
+        'seconds': time.time() - started,
+        'success': success,
+        'peak_rss': peak_rss(),
+        'feeds': feeds,
+        'skipped': skipped,
+        'slow_queries': slow_queries,
+    }
+
+def prometheus(rep):
+    """ run report in prometheus text exposition format """
+    lines = []
+
+    def metric(name, help, values):
+        lines.append('# HELP samba_export_{} {}'.format(name, help))
+        lines.append('# TYPE samba_export_{} gauge'.format(name))
+        for labels, value in values:
+            labels = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+            lines.append('samba_export_{}{} {}'.format(name,
+                         '{' + labels + '}' if labels else '', value))
+
+    items = rep['feeds'].items()
+    metric('last_run_timestamp_seconds', 'Start time of the last export.',
+           [((), rep['started'])])
+    metric('success', 'Whether the last export succeeded.',
+           [((), int(rep['success']))])
+    metric('run_duration_seconds', 'Duration of the last export.',
+           [((), rep['seconds'])])
+    metric('peak_rss_bytes', 'Peak resident memory of the last export.',
+           [((), rep['peak_rss'])])
+    metric('feed_duration_seconds', 'Export time of feed.',
+           [((('feed', k),), v.get('seconds', 0)) for k, v in items])
+    metric('feed_rows', 'Records exported into feed.',
+           [((('feed', k),), v['rows']) for k, v in items])
+    metric('feed_rows_per_second', 'Feed export throughput.',
+           [((('feed', k),), v['rows'] / v['seconds'] if v.get('seconds')
+             else 0) for k, v in items])
+    metric('feed_queries', 'SQL queries executed by feed.',
+           [((('feed', k),), v['queries']) for k, v in items])
+    metric('feed_slow_queries', 'Slow SQL queries executed by feed.',
+           [((('feed', k),), v['slow_queries']) for k, v in items])
+    metric('feed_retries', 'SQL queries of feed retried after connection '
+           'error.', [((('feed', k),), v.get('retries', 0)) for k, v in items])
+    metric('feed_skipped', 'Feed was skipped, its tables did not change.',
+           [((('feed', k),), 0) for k, v in items] +
+           [((('feed', k),), 1) for k in rep.get('skipped', ())])
+    metric('feed_stage_seconds', 'Export time of feed by stage.',
+           [((('feed', k), ('stage', s)), t) for k, v in items
+            for s, t in sorted(v['stages'].items())])
+    return '\n'.join(lines) + '\n'
+
+def save(rep, json_fname = None, prometheus_fname = None):
+    """ write report files atomically, None skips the file """
+    for fname, data in ((json_fname, lambda: json.dumps(rep, indent = 1)),
+                        (prometheus_fname, lambda: prometheus(rep))):
+        if not fname:
+            continue
+        tmp = fname + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data())
+        os.replace(tmp, fname)
@@ -1,10 +1,29 @@
+import functools
 import sys
 import config
 from config import *
 from peewee import *
-
-db = MySQLDatabase(DB_NAME, user = DB_USER, password = DB_PASSWORD,
-                  host = DB_HOST, port = DB_PORT)
+from pymysql.cursors import SSCursor
+import metrics
+
+class MeasuredDatabase(MySQLDatabase):
+    """ MySQLDatabase reporting executed queries to metrics """
+    def execute_sql(self, sql, *args, **kwargs):
+        with metrics.query(sql):
+            return super().execute_sql(sql, *args, **kwargs)
+
+db = MeasuredDatabase(DB_NAME, user = DB_USER, password = DB_PASSWORD,
+                      host = DB_HOST, port = DB_PORT)
+
+def stream_db():
+    """
+        new connection reading results by unbuffered server side cursor,
+        MySQL allows only one such result to be read at a time, so every
+        concurrently read query needs its own connection
+    """
+    return MeasuredDatabase(DB_NAME, user = DB_USER, password = DB_PASSWORD,
+                            host = DB_HOST, port = DB_PORT,
+                            cursorclass = SSCursor)
 
 #we are using the db readonly so we don't have to fill in all the fiels
 
@@ -90,6 +109,16 @@ class Order(Model):
         db_table = PREFIX + '_orders'
         database = db
 
+class OrderHistory(Model):
+    id_order_history = IntegerField(primary_key = True)
+    id_order = IntegerField()
+    id_order_state = IntegerField()
+    date_add = DateTimeField()
+
+    class Meta:
+        db_table = PREFIX + '_order_history'
+        database = db
+
 class OrderDetail(Model):
     id_order_detail = IntegerField(primary_key = True)
     id_order = ForeignKeyField(Order, column_name = 'id_order', object_id_name =
@@ -113,6 +142,7 @@ class Product(Model):
     id_shop_default = IntegerField()
     id_category_default = IntegerField()
     id_tax_rules_group = IntegerField()
+    id_manufacturer = IntegerField()
     on_sale = IntegerField()
     quantity = IntegerField()
     price = FloatField()
@@ -126,6 +156,7 @@ class Product(Model):
     depth = FloatField()
     height = FloatField()
     weight = FloatField()
+    date_upd = DateTimeField()
 
     class Meta:
         db_table = PREFIX + '_product'
@@ -301,6 +332,26 @@ class ProductCategory(Model):
         database = db
         primary_key = False
 
+class ProductSupplier(Model):
+    id_product_supplier = IntegerField(primary_key = True)
+    id_product = IntegerField()
+    id_product_attribute = IntegerField()
+    id_supplier = IntegerField()
+
+    class Meta:
+        db_table = PREFIX + '_product_supplier'
+        database = db
+
+class FeatureProduct(Model):
+    id_feature = IntegerField()
+    id_product = IntegerField()
+    id_feature_value = IntegerField()
+
+    class Meta:
+        db_table = PREFIX + '_feature_product'
+        database = db
+        primary_key = False
+
 class Tax(Model):
     id_tax = IntegerField(primary_key = True)
     rate = FloatField()
@@ -324,30 +375,85 @@ class Image(Model):
         db_table = PREFIX + '_image'
         database = db
 
-#get language id from db
-LANG_ID = config.LANG_ID = int(Language.select().where(Language.iso_code ==
-                                                   LANG).get().id_lang)
-#get prestashop version from DB
-PS_VERSION = config.PS_VERSION = Config.select().where(Config.name ==
-                                              'PS_VERSION_DB').get().value
-
-if not config.SHOP_ID:
-    SHOP_ID = config.SHOP_ID = int(Config.select().where(Config.name ==
-                                              'PS_SHOP_DEFAULT').get().value)
-if not config.COUNTRY_ID:
-    COUNTRY_ID = config.COUNTRY_ID = int(Config.select().where(Config.name ==
-                                              'PS_COUNTRY_DEFAULT').get().value)
-
-PS_SPECIFIC_PRICE_PRIORITY = config.PS_SPECIFIC_PRICE_PRIORITY = Config.select().where(Config.name ==
-                                              'PS_SPECIFIC_PRICE_PRIORITIES').get().value
-
-#print(PS_SPECIFIC_PRICE_PRIORITY)
-
-PS_SPECIFIC_PRICE = config.PS_SPECIFIC_PRICE = bool(int(Config.select().where(Config.name ==
-                                              'PS_SPECIFIC_PRICE_FEATURE_ACTIVE').get().value))
-
-if config.SPECIFIC_PRICE and not PS_SPECIFIC_PRICE:
-    config.SPECIFIC_PRICE = False
-    print("PS_SPECIFIC_PRICE is not enabled in PS config, disabling in"
-          " exporter", file = sys.stderr)
-
+class ShopContext(object):
+    """
+        shop settings of one export, values set in config.py win over
+        prestashop configuration
+
+        lang, lang_id - exported language
+        shop_id, shop_group_id, country_id - exported shop and its country
+        ps_version - prestashop version of database
+        ps_specific_price_priority - PS_SPECIFIC_PRICE_PRIORITIES
+        ps_specific_price - specific prices are enabled in prestashop
+        specific_price - SPECIFIC_PRICE of config.py and ps_specific_price
+        output_directory - directory of exported feeds
+    """
+    SETTINGS = ('PS_VERSION_DB', 'PS_SHOP_DEFAULT', 'PS_COUNTRY_DEFAULT',
+                'PS_SPECIFIC_PRICE_PRIORITIES',
+                'PS_SPECIFIC_PRICE_FEATURE_ACTIVE')
+
+    def __init__(self, lang, lang_id, settings, shop_id = None,
+                 country_id = None, output_directory = None):
+        self.lang = lang
+        self.lang_id = lang_id
+        self.ps_version = settings['PS_VERSION_DB']
+        self.shop_id = shop_id or int(settings['PS_SHOP_DEFAULT'])
+        self.shop_group_id = config.SHOP_GROUP_ID
+        self.country_id = country_id or int(settings['PS_COUNTRY_DEFAULT'])
+        self.ps_specific_price_priority = \
+                settings['PS_SPECIFIC_PRICE_PRIORITIES']
+        self.ps_specific_price = \
+                bool(int(settings['PS_SPECIFIC_PRICE_FEATURE_ACTIVE']))
+        self.specific_price = config.SPECIFIC_PRICE and self.ps_specific_price
+        self.output_directory = output_directory or config.OUTPUT_DIRECTORY
+
+
+@functools.lru_cache(maxsize = None)
+def shop_settings():
+    """ prestashop configuration used by exporter, read by one query """
+    settings = {row.name: row.value for row in
+                Config.select(Config.name, Config.value)
+                      .where(Config.name.in_(ShopContext.SETTINGS))}
+    missing = [name for name in ShopContext.SETTINGS if name not in settings]
+    if missing:
+        raise ValueError("missing prestashop configuration "
+                         "{}".format(", ".join(missing)))
+    return settings
+
+
+@functools.lru_cache(maxsize = None)
+def language_ids():
+    """ id_lang by iso code """
+    return {lang.iso_code: lang.id_lang for lang in
+            Language.select(Language.id_lang, Language.iso_code)}
+
+
+@functools.lru_cache(maxsize = None)
+def shop_context(lang = None, shop_id = None, country_id = None,
+                 output_directory = None):
+    """
+        cached ShopContext, arguments default to LANG, SHOP_ID, COUNTRY_ID
+        and OUTPUT_DIRECTORY of config.py
+        database is queried by the first call after clear_settings only
+    """
+    lang = lang or config.LANG
+    lang_ids = language_ids()
+    if lang not in lang_ids:
+        raise ValueError("unknown language {}".format(lang))
+    ctx = ShopContext(lang, int(lang_ids[lang]), shop_settings(),
+                      shop_id or config.SHOP_ID,
+                      country_id or config.COUNTRY_ID, output_directory)
+    if config.SPECIFIC_PRICE and not ctx.ps_specific_price:
+        print("PS_SPECIFIC_PRICE is not enabled in PS config, disabling in"
+              " exporter", file = sys.stderr)
+    return ctx
+
+
+def clear_settings():
+    """
+        forget cached prestashop configuration and languages, the next
+        shop_context reads them again, called by every export run
+    """
+    shop_settings.cache_clear()
+    language_ids.cache_clear()
+    shop_context.cache_clear()
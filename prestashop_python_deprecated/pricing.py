@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+"""
+    batch price computation
+    (C) 2026 DiffSolutions s.r.o.
+    Licensed under CC BY-SA 4.0
+
+    * prices of a chunk of products and variants are collected into
+      PriceBatch and computed at once, see PRICE_BACKEND in config.py
+    * 'numpy' backend computes the chunk by vectorized operations, numpy
+      module is imported only if it is used
+    * results are the same floats as exporter.specific_price computes,
+      operations are done in the same order in both backends
+"""
+
+#kinds of reduction of specific price
+NONE = 0
+PERCENTAGE = 1
+AMOUNT_TAX = 2 #amount with tax
+AMOUNT = 3 #amount without tax
+
+def reduction(sp):
+    """ (kind, reduction) of matched specific price, sp can be None """
+    if sp is None:
+        return (NONE, 0.0)
+    if sp['reduction_type'] == 'percentage':
+        return (PERCENTAGE, sp['reduction'])
+    if sp['reduction_type'] == 'amount':
+        if sp.get('reduction_tax'):
+            return (AMOUNT_TAX, sp['reduction'])
+        return (AMOUNT, sp['reduction'])
+    raise NotImplementedError("reduction type {} is not "
+                              "implemented/supported".format(sp['reduction_type']))
+
+class PriceBatch(object):
+    """ prices collected by add(), computed by compute() """
+    def __init__(self):
+        self.price = []
+        self.tax = []
+        self.kind = []
+        self.reduction = []
+        self.specific = []
+
+    def __len__(self):
+        return len(self.price)
+
+    def add(self, price, tax, sp):
+        """
+            price - base price with price of combination, tax - tax rate,
+            sp - matched specific price or None, returns index of result
+        """
+        kind, red = reduction(sp)
+        self.price.append(price)
+        self.tax.append(tax)
+        self.kind.append(kind)
+        self.reduction.append(red)
+        self.specific.append(sp)
+        return len(self.price) - 1
+
+    def bad_percentage(self, ix):
+        return ValueError("bad percentage for SpecificPrice "
+                          "{}".format(self.specific[ix]))
+
+    def compute(self, backend = 'python'):
+        """ list of (price, price before discount) with tax """
+        if backend == 'numpy':
+            return self.compute_numpy()
+        if backend != 'python':
+            raise ValueError("unknown price backend {}".format(backend))
+        result = []
+        for ix, (price, tax, kind, red) in enumerate(zip(self.price,
+                self.tax, self.kind, self.reduction)):
+            before = price * (1 + tax)
+            if kind == PERCENTAGE:
+                price2 = price * (1 - red)
+                if price2 > price:
+                    raise self.bad_percentage(ix)
+                result.append((price2 * (1 + tax), before))
+            elif kind == AMOUNT_TAX:
+                result.append((before - red, before))
+            elif kind == AMOUNT:
+                result.append(((price - red) * (1 + tax), before))
+            else:
+                result.append((before, before))
+        return result
+
+    def compute_numpy(self):
+        import numpy
+        if not self.price:
+            return []
+        price = numpy.array(self.price, dtype = numpy.float64)
+        tax = numpy.array(self.tax, dtype = numpy.float64) + 1
+        kind = numpy.array(self.kind, dtype = numpy.int8)
+        red = numpy.array(self.reduction, dtype = numpy.float64)
+        before = price * tax
+        price2 = price * (1 - red)
+        bad = (kind == PERCENTAGE) & (price2 > price)
+        if bad.any():
+            raise self.bad_percentage(int(bad.argmax()))
+        final = numpy.select([kind == PERCENTAGE, kind == AMOUNT_TAX,
+                              kind == AMOUNT],
+                             [price2 * tax, before - red, (price - red) * tax],
+                             before)
+        return list(zip(final.tolist(), before.tolist()))
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+"""
+    cache of serialized feed records
+    (C) 2026 DiffSolutions s.r.o.
+    Licensed under CC BY-SA 4.0
+
+    * records are stored in sqlite file with digest of data they were
+      built from, record with the same digest is copied into feed
+      without building and serializing it again
+    * records are keyed by target and record key (id_product), records
+      not seen by the last run are dropped when cache is closed, unless
+      run exports only part of records (resumed export)
+"""
+
+import sqlite3
+
+class RecordCache(object):
+    def __init__(self, fname, prune = True):
+        self.prune = prune
+        self.db = sqlite3.connect(fname)
+        self.db.execute("CREATE TABLE IF NOT EXISTS records ("
+                        "target TEXT, key INTEGER, digest TEXT, xml BLOB, "
+                        "PRIMARY KEY (target, key))")
+        self.seen = []
+        self.changed = []
+        self.hits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, val, tb):
+        if typ is None:
+            self.close()
+        else:
+            self.db.rollback()
+            self.db.close()
+
+    def get(self, target, key, digest):
+        """ serialized record of target with key, None if digest differs """
+        self.seen.append((target, key))
+        row = self.db.execute("SELECT digest, xml FROM records WHERE "
+                              "target = ? AND key = ?", (target, key))\
+                     .fetchone()
+        if row is None or row[0] != digest:
+            return None
+        self.hits += 1
+        return row[1]
+
+    def put(self, target, key, digest, xml):
+        self.changed.append((target, key, digest, xml))
+        if len(self.changed) >= 1000:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany("INSERT OR REPLACE INTO records VALUES "
+                            "(?, ?, ?, ?)", self.changed)
+        self.changed = []
+
+    def close(self):
+        """ store changed records and drop records not seen """
+        self.flush()
+        if not self.prune:
+            self.db.commit()
+            self.db.close()
+            return
+        self.db.execute("CREATE TEMP TABLE seen (target TEXT, key INTEGER, "
+                        "PRIMARY KEY (target, key))")
+        self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?)",
+                            self.seen)
+        self.db.execute("DELETE FROM records WHERE NOT EXISTS (SELECT 1 "
+                        "FROM seen WHERE seen.target = records.target AND "
+                        "seen.key = records.key)")
+        self.db.commit()
+        self.db.close()
@@ -6,35 +6,244 @@
     (C) 2018 DiffSolutions s.r.o.
     Licensed under CC BY-SA 4.0
 
+    * feed records are lxml elements or light Record objects,
+      Records are serialized by string writer without building lxml tree
+    * already serialized records (bytes) are written as they are
 """
 
 from lxml.etree import tostring
+from lxml import etree
+import gzip
+import os
+import re
+
+#characters refused by lxml
+INVALID_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+#characters to be escaped or refused, text without them is written as is
+SPECIAL = re.compile('[&<>\r\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+special = SPECIAL.search
+
+def escape(text):
+    """ escape text same way as lxml does """
+    if type(text) is not str:
+        if type(text) is not bytes:
+            raise TypeError("Argument must be bytes or unicode, got "
+                            "'{}'".format(type(text).__name__))
+        text = text.decode('UTF-8')
+    if special(text) is None:
+        return text
+    if INVALID_XML.search(text):
+        raise ValueError("All strings must be XML compatible: Unicode or "
+                         "ASCII, no NULL bytes or control characters")
+    return text.replace('&', '&amp;').replace('<', '&lt;')\
+               .replace('>', '&gt;').replace('\r', '&#13;')
+
+
+class Record(object):
+    """
+        light replacement of lxml element, supports part of lxml API
+        used by exporter (text, append, findtext, SubElement)
+        serialized output is identical to lxml tostring
+    """
+    __slots__ = ('tag', 'text', 'children')
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.text = None
+        self.children = []
+
+    def append(self, child):
+        self.children.append(child)
+
+    def findtext(self, tag, default = None):
+        for child in self.children:
+            if child.tag == tag:
+                if child.text is None:
+                    return ''
+                return child.text.decode('UTF-8') if type(child.text) is \
+                        bytes else child.text
+        return default
+
+    def serialize(self, append):
+        tag = self.tag
+        text = self.text
+        if text is None:
+            if not self.children:
+                append('<' + tag + '/>')
+                return
+            append('<' + tag + '>')
+        elif type(text) is str and special(text) is None:
+            append('<' + tag + '>' + text)
+        else:
+            append('<' + tag + '>' + escape(text))
+        for child in self.children:
+            if child.children:
+                child.serialize(append)
+                continue
+            #leaf elements inlined, most of records are leafs
+            tag = child.tag
+            text = child.text
+            if text is None:
+                append('<' + tag + '/>')
+            elif type(text) is str and special(text) is None:
+                append('<' + tag + '>' + text + '</' + tag + '>')
+            else:
+                append('<' + tag + '>' + escape(text) + '</' + tag + '>')
+        append('</' + self.tag + '>')
+
+    def tostring(self):
+        out = []
+        self.serialize(out.append)
+        return ''.join(out).encode('ascii', 'xmlcharrefreplace')
+
+
+def leaf(tag, text):
+    """ serialized element with text only, the same as lxml tostring """
+    if text is None:
+        return '<' + tag + '/>'
+    return '<' + tag + '>' + escape(text) + '</' + tag + '>'
+
+
+def serialize(xml):
+    """ bytes of lxml element or Record """
+    if type(xml) is Record:
+        return xml.tostring()
+    return tostring(xml)
+
+
+def SubElement(parent, tag):
+    """ lxml SubElement working for Record parents too """
+    if type(parent) is Record:
+        child = Record(tag)
+        parent.children.append(child)
+        return child
+    return etree.SubElement(parent, tag)
+
 
 class Feed(object):
-    def __init__(self, name, fname, tag):
-        self.f = f = open(fname, "wb+")
+    """
+        feed file writer, feed is written into temporary file and renamed
+        to fname on close, so readers never see partially written feed.
+        If with block fails, previous feed file is kept.
+
+        compress - list of precompressed copies written alongside,
+            'gzip' (fname.gz) or 'zstd' (fname.zst, needs zstandard module)
+        resume - size of partially written fname.tmp kept by failed export,
+            writing continues at this offset, compressed copies are
+            written again from the kept part
+        keep - failed feed keeps fname.tmp for resume
+    """
+    def __init__(self, name, fname, tag, compress = (), compress_level = 6,
+                 resume = None, keep = False):
         self.name = name
         self.tag = tag
-        self.header()
+        self.keep = keep
+        if resume is None:
+            self.outputs = [(open(fname + '.tmp', "wb"), fname)]
+        else:
+            f = open(fname + '.tmp', "r+b")
+            f.truncate(resume)
+            f.seek(resume)
+            self.outputs = [(f, fname)]
+        for fmt in compress:
+            self.outputs.append(self.compressed(fname, fmt, compress_level))
+        if resume is None:
+            self.header()
+        else:
+            self.copy_kept(fname + '.tmp', resume)
+
+    @staticmethod
+    def compressed(fname, fmt, level):
+        if fmt == 'gzip':
+            fname = fname + '.gz'
+            raw = open(fname + '.tmp', 'wb')
+            #name without .tmp in gzip header, gzip doesn't close raw file
+            f = gzip.GzipFile(os.path.basename(fname[:-3]), 'wb', level, raw)
+            f.raw = raw
+            return (f, fname)
+        if fmt == 'zstd':
+            import zstandard
+            fname = fname + '.zst'
+            raw = open(fname + '.tmp', 'wb')
+            return (zstandard.ZstdCompressor(level = level)\
+                    .stream_writer(raw), fname)
+        raise ValueError("unknown compression {}".format(fmt))
+
+    def copy_kept(self, tmp, size):
+        """ write kept part of feed into compressed copies """
+        with open(tmp, 'rb') as f:
+            while size > 0:
+                data = f.read(min(size, 1 << 20))
+                size -= len(data)
+                for out, fname in self.outputs[1:]:
+                    out.write(data)
 
     def __exit__(self, typ, val, tb):
-        self.close()
+        if typ is None:
+            self.close()
+        else:
+            self.abort()
 
     def __enter__(self):
         return self
 
     def close(self):
         self.footer()
-        self.f.close()
+        self.close_files()
+        for f, fname in self.outputs:
+            os.replace(fname + '.tmp', fname)
+
+    def abort(self):
+        """ drop partially written feed, plain file is kept if keep is set """
+        self.close_files()
+        for f, fname in self.outputs[1 if self.keep else 0:]:
+            os.remove(fname + '.tmp')
+
+    def tell(self):
+        """ size of plain feed file written so far """
+        f = self.outputs[0][0]
+        f.flush()
+        return f.tell()
+
+    def close_files(self):
+        for f, fname in self.outputs:
+            f.close()
+            if hasattr(f, 'raw'):
+                f.raw.close()
+
+    def _write(self, data):
+        for f, fname in self.outputs:
+            f.write(data)
+
+    def header_bytes(self):
+        return '''<?xml version="1.0"
+                     encoding="utf-8"?>\n<{}>\n'''.format(self.tag).encode("UTF-8")
+
+    def footer_bytes(self):
+        return "</{}>\n".format(self.tag).encode('UTF-8')
 
     def header(self):
-        self.f.write('''<?xml version="1.0"
-                     encoding="utf-8"?>\n<{}>\n'''.format(self.tag).encode("UTF-8"))
+        self._write(self.header_bytes())
 
     def footer(self):
-        self.f.write("</{}>\n".format(self.tag).encode('UTF-8'))
-
-    def write(self, xml):
-        self.f.write(tostring(xml) + b"\n")
+        self._write(self.footer_bytes())
 
+    def append_feed(self, fname):
+        """ copy records of feed file fname written by Feed with the same tag """
+        header = self.header_bytes()
+        size = os.path.getsize(fname) - len(header) - len(self.footer_bytes())
+        with open(fname, 'rb') as f:
+            if f.read(len(header)) != header:
+                raise ValueError("{} is not {} feed".format(fname, self.tag))
+            while size > 0:
+                data = f.read(min(size, 1 << 20))
+                size -= len(data)
+                self._write(data)
 
+    def write(self, xml):
+        if type(xml) is bytes:
+            self._write(xml + b"\n")
+        elif type(xml) is Record:
+            self._write(xml.tostring() + b"\n")
+        else:
+            self._write(tostring(xml) + b"\n")